@@ -1,99 +1,353 @@
-import collections
-import copy
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import os
 from PyQt5 import QtCore
 import serial
-import struct
 import threading
 import time
 
 import utility.conversions as conversions
+from utility.ring_buffer import RingBuffer
+
+FRAME_SYNC = b'\xaa\x55'  # marker preceding each frame sent by sensor_adc.ino
+
+
+def split_frames(buffer, frame_size):
+    """
+    Locate sync-marked frames in a byte buffer.
+
+    A frame is only accepted once the sync marker of the following frame has arrived, so that a marker pattern
+    inside the payload cannot desynchronise the stream. Returns the list of frame payloads and the number of bytes
+    of the buffer that have been consumed.
+    """
+    frames = []
+    sync_size = len(FRAME_SYNC)
+    position = 0
+    while True:
+        start = buffer.find(FRAME_SYNC, position)
+        if start == -1:  # keep a possible partial marker at the end of the buffer
+            return frames, max(position, len(buffer) - sync_size + 1)
+        end = start + sync_size + frame_size
+        if end + sync_size > len(buffer):
+            return frames, start
+        if buffer[end:end + sync_size] != FRAME_SYNC:
+            position = start + 1  # marker was part of a payload, resynchronise
+            continue
+        frames.append(bytes(buffer[start + sync_size:end]))
+        position = end
+
+
+class DummySource:
+    """
+    Synthetic sensor board: a thermistor drifting slowly around 25 C and irradiance diodes around 1000 W/m2 with
+    lamp flicker and noise, encoded as ADC values exactly as sensor_adc.ino sends them.
+    """
+    def __init__(self, n_ai=5, data_type='h', temperature=25.0, irradiance=1000.0, noise=1.0, seed=None):
+        self.n_ai = n_ai
+        self.frame_dtype = np.dtype('<' + data_type)
+        self.temperature = temperature
+        self.irradiance = irradiance
+        self.noise = noise  # scales the noise of all channels, 0 gives clean waveforms
+        self.rng = np.random.default_rng(seed)
+
+    def codes(self, times):
+        """ Returns the ADC values for the given sample times (s) with the shape (n_ai, n_frames). """
+        times = np.asarray(times, dtype=np.float64)
+        temperature = self.temperature + 0.5 * np.sin(2 * np.pi * times / 300.) + \
+            self.rng.normal(0, 0.05 * self.noise, times.size)
+        phases = np.arange(1, self.n_ai)[:, np.newaxis]
+        irradiance = self.irradiance * (1 + 0.01 * np.sin(2 * np.pi * times / 10. + phases)) + \
+            self.rng.normal(0, 2. * self.noise, (self.n_ai - 1, times.size))
+        voltages = np.vstack([conversions.temperature_to_voltage(temperature),
+                              conversions.power_to_voltage(irradiance)])
+        codes = conversions.voltage_to_digital(voltages, bits=15, voltage_range=6.144)
+        if self.frame_dtype.kind == 'i':
+            codes = np.round(codes)
+        return codes.astype(self.frame_dtype)
+
+    def generate(self, times):
+        """ Returns the concatenated frame payloads for the given sample times (s). """
+        return self.codes(times).T.tobytes()
 
 
 class SerialRead(QtCore.QObject):
     to_log = QtCore.pyqtSignal(str)
 
-    def __init__(self, serial_port='COM3', serial_baud=38400, n_data_points=100, data_num_bytes=2, n_ai=5):
+    def __init__(self, serial_port='COM3', serial_baud=38400, n_data_points=100, data_num_bytes=2, n_ai=5,
+                 n_frames=100000, dummy_rate=200.0, reconnect_period=1.0, sample_period=0.25):
         super(SerialRead, self).__init__()
         self.port = serial_port
+        self.synthetic = str(self.port) == 'dummy'  # feed synthetic frames instead of reading a port
+        self.dummy_rate = dummy_rate  # frames per second produced in dummy mode
+        self.reconnect_period = reconnect_period  # seconds between attempts to reopen a lost port
         self.baud = serial_baud
         self.n_data_points = n_data_points
         self.data_num_bytes = data_num_bytes
         self.n_ai = n_ai
-        self.raw_data = bytearray(self.n_ai * self.data_num_bytes)
+        self.n_frames = n_frames  # number of received frames kept in the stream history
+        self.sample_period = sample_period  # seconds between the samples recorded in the plotted history
+        self.frame_size = self.n_ai * self.data_num_bytes
         self.data_type = None
         if self.data_num_bytes == 2:
             self.data_type = 'h'  # 2 byte integer
         elif self.data_num_bytes == 4:
             self.data_type = 'f'  # 4 byte float
-        self.data = []
-        self.times = []
-        self.init_time = time.time()
-        self.private_data = None
-        for i in range(self.n_ai):  # give an array for each type of data and store them in a list
-            self.data.append(collections.deque([0] * self.n_data_points, maxlen=self.n_data_points))
-            self.times.append(collections.deque([0.1] * self.n_data_points, maxlen=self.n_data_points))
-        self.is_run = True
-        self.is_receiving = False
-        self.thread = None
+        self.frame_dtype = np.dtype('<' + self.data_type)  # Arduino sends little-endian values
+        # channel 0 is the thermistor, all further channels are irradiance diodes
+        self.conversions = [conversions.voltage_to_temperature] + \
+                           [conversions.voltage_to_power] * (self.n_ai - 1)
+        self.lookup_table = None
+        if self.data_num_bytes == 2:  # integer ADC codes are converted through one lookup table per channel
+            self.lookup_table = np.vstack([conversions.adc_lookup_table(conversion, bits=15, voltage_range=6.144)
+                                           for conversion in self.conversions])
+        self.channel_index = np.arange(self.n_ai)[:, np.newaxis]
+        self.init_time = time.monotonic()
+        # double buffered [time, channel values] of the latest frame, guarded by a sequence counter (seqlock)
+        self.snapshots = np.zeros((2, self.n_ai + 1))
+        self.snapshots[:, 1:] = self.convert(np.zeros((self.n_ai, 1), dtype=self.frame_dtype))[:, 0]
+        self.snapshot_sequence = 0  # odd while a new snapshot is being published
+        self.snapshot_front = 0
+        # plotted history of all channels, sampled every sample_period seconds of frame time while frames arrive,
+        # and converted values with host receive time of every frame
+        self.history = RingBuffer(self.n_ai, self.n_data_points)
+        self.history_lock = threading.Lock()
+        self.next_sample = 0.  # frame time of the next sample
+        self.frames = RingBuffer(self.n_ai, self.n_frames)
+        self.frames_lock = threading.Lock()  # frames are written by the reader and read by other threads
+        self.frames_received = 0
+        self.bytes_discarded = 0
+        self.log = None  # SensorLog that every stored frame is written to
+        self.stream = bytearray()  # received bytes not yet split into frames
+        self.connected = threading.Event()  # set while frames arrive, cleared when the link is lost
+        self.failed_connects = 0  # number of attempts to open the port that failed
         self.serialConnection = None
+        self.read_executor = None  # thread of blocking port reads where the engine loop cannot watch the port
 
-    def connect(self):
-        if str(self.port) == 'dummy':
-            return
-        self.to_log.emit('<span style=\" color:#000000;\" >Trying to connect to: ' + str(self.port) + ' at '
-                         + str(self.baud) + ' BAUD.</span>')
+    def connect(self, verbose=True):
+        """ Opens the serial port, returns False if that fails. Without verbose only a success is logged. """
+        if self.synthetic:
+            return True
+        if verbose:
+            self.to_log.emit('<span style=\" color:#000000;\" >Trying to connect to: ' + str(self.port) + ' at '
+                             + str(self.baud) + ' BAUD.</span>')
         try:
             self.serialConnection = serial.Serial(self.port, self.baud, timeout=4)
             self.to_log.emit('<span style=\" color:#32cd32;\" >Connected to ' + str(self.port) + ' at ' +
                              str(self.baud) + ' BAUD.</span>')
         except serial.serialutil.SerialException:
-            self.port = 'dummy'
-            self.to_log.emit('<span style=\" color:#ff0000;\" >Failed to connect with ' + str(self.port) +
-                             ' at ' + str(self.baud) + ' BAUD.</span>')
-
-    def read_serial_start(self):
-        if self.thread is None:
-            self.thread = threading.Thread(target=self.background_thread)
-            self.thread.start()
-            # Block till we start receiving values
-            while not self.is_receiving:
-                time.sleep(0.1)
+            self.serialConnection = None
+            self.failed_connects += 1
+            if verbose:
+                self.to_log.emit('<span style=\" color:#ff0000;\" >Failed to connect with ' + str(self.port) +
+                                 ' at ' + str(self.baud) + ' BAUD.</span>')
+            return False
+        return True
+
+    def snapshot(self):
+        """
+        Returns [time, channel 0, ..., channel n_ai - 1] of the latest frame as a new array.
+
+        All values stem from the same frame. Reading does not touch any history, so it can be called from the GUI
+        thread at any rate.
+        """
+        while True:
+            sequence = self.snapshot_sequence
+            if sequence % 2 == 0:
+                snapshot = self.snapshots[self.snapshot_front].copy()
+                if sequence == self.snapshot_sequence:
+                    return snapshot
+            time.sleep(0)  # writer is publishing, yield to it
+
+    def publish_snapshot(self, frame_time, values):
+        back = 1 - self.snapshot_front
+        self.snapshot_sequence += 1
+        self.snapshots[back, 0] = frame_time
+        self.snapshots[back, 1:] = values
+        self.snapshot_front = back
+        self.snapshot_sequence += 1
 
     def get_serial_data(self, plt_number):
-        self.times[plt_number].append(time.time() - self.init_time)
-        self.private_data = copy.deepcopy(
-            self.raw_data)  # so that the 5 values in our plots will be synchronized to the same sample time
-        data = self.private_data[(plt_number * self.data_num_bytes):(self.data_num_bytes +
-                                                                     plt_number * self.data_num_bytes)]
-        value,  = struct.unpack(self.data_type, data)
-        if plt_number == 0:
-            value = conversions.voltage_to_temperature(conversions.digital_to_voltage(value, bits=15,
-                                                                                      voltage_range=6.144))
-        else:
-            value = conversions.voltage_to_power(conversions.digital_to_voltage(value, bits=15, voltage_range=6.144))
-        self.data[plt_number].append(value)  # we get the latest data point and append it to our array
-        return self.times[plt_number], self.data[plt_number], self.data[plt_number][-1]
-
-    def background_thread(self):  # retrieve data
-        time.sleep(1.0)  # give some buffer time for retrieving data
-        while self.is_run:
-            if str(self.port) == 'dummy':
-                self.is_receiving = True
-            else:
+        """ Sample times and values of one channel from the history, and its latest value. Records nothing. """
+        with self.history_lock:
+            times, values = self.history.get_times().copy(), self.history.get_values(plt_number).copy()
+        return times, values, self.snapshot()[plt_number + 1]
+
+    def get_samples(self, count=0):
+        """
+        Times and values (n_ai, n) of the samples recorded after the first count ones, with the number of samples
+        recorded so far. Samples that dropped out of the history in between are skipped.
+        """
+        with self.history_lock:
+            n_samples = max(0, min(self.history.count - count, len(self.history)))
+            return self.history.get_times(n_samples).copy(), self.history.get_values(n_samples=n_samples).copy(), \
+                self.history.count
+
+    def get_frames(self, start=None, end=None):
+        """ Times and values (n_ai, n) of the received frames with start <= time <= end, as consistent copies. """
+        with self.frames_lock:
+            if start is None:
+                window = self.frames.window()
+                return self.frames.times[window].copy(), self.frames.values[:, window].copy()
+            times, values = self.frames.between(start, end)
+            return times.copy(), values.copy()
+
+    def record_samples(self, frame_times, values):
+        """ Records the first frame at or after each multiple of sample_period in the history. """
+        if frame_times[-1] < self.next_sample:
+            return
+        if frame_times[0] > self.next_sample:  # skip the sample times of a gap in the stream
+            self.next_sample += np.floor((frame_times[0] - self.next_sample) / self.sample_period) * self.sample_period
+        n_samples = int((frame_times[-1] - self.next_sample) / self.sample_period) + 1
+        sample_times = self.next_sample + self.sample_period * np.arange(n_samples)
+        frames = np.unique(np.minimum(np.searchsorted(frame_times, sample_times, side='left'), frame_times.size - 1))
+        with self.history_lock:
+            self.history.extend(frame_times[frames], values[:, frames])
+        self.next_sample = sample_times[-1] + self.sample_period
+
+    def decode(self, payload):
+        """ Returns the raw channel values of a block of frame payloads with the shape (n_ai, n_frames). """
+        return np.frombuffer(payload, dtype=self.frame_dtype).reshape(-1, self.n_ai).T
+
+    def convert(self, raw):
+        """ Converts raw channel values of the shape (n_ai, n_frames) to temperature and irradiance. """
+        if self.lookup_table is not None:
+            return self.lookup_table[self.channel_index, raw.view(np.uint16)]
+        voltages = conversions.digital_to_voltage(raw.astype(np.float64), bits=15, voltage_range=6.144)
+        return np.vstack([conversion(voltages[i]) for i, conversion in enumerate(self.conversions)])
+
+    def store_frames(self, payload, receive_times):
+        """ Stores a block of concatenated frame payloads, receive_times is one time or one time per frame. """
+        values = self.convert(self.decode(payload))
+        n_frames = values.shape[1]
+        receive_times = np.broadcast_to(np.asarray(receive_times, dtype=np.float64), (n_frames,))
+        with self.frames_lock:
+            self.frames.extend(receive_times, values)
+        self.record_samples(receive_times, values)
+        log = self.log
+        if log is not None:
+            log.append(receive_times, values)
+        self.publish_snapshot(receive_times[-1], values[:, -1])
+        self.frames_received += n_frames
+        self.connected.set()
+
+    def lose_connection(self):
+        self.connected.clear()
+        try:
+            self.serialConnection.close()
+        except (OSError, serial.serialutil.SerialException):
+            pass
+        self.serialConnection = None
+        self.to_log.emit('<span style=\" color:#ff0000;\" >Lost connection to Arduino, trying to '
+                         'reconnect. Check connection and refresh COM ports.</span>')
+
+    def start_stream(self):
+        self.stream = bytearray()
+        try:
+            self.serialConnection.reset_input_buffer()  # discard bytes queued before the stream starts
+        except (OSError, serial.serialutil.SerialException):
+            pass
+
+    def feed(self, chunk, receive_time):
+        """ Appends received bytes to the stream and stores the frames completed by them. """
+        self.stream.extend(chunk)
+        frames, consumed = split_frames(self.stream, self.frame_size)
+        self.bytes_discarded += consumed - len(frames) * (len(FRAME_SYNC) + self.frame_size)
+        if frames:
+            self.store_frames(b''.join(frames), receive_time)
+        del self.stream[:consumed]
+
+    def read_chunk(self, connection):
+        """ Blocks until a frame worth of bytes has arrived, returns everything queued with its receive time. """
+        chunk = connection.read(max(connection.in_waiting, len(FRAME_SYNC) + self.frame_size))
+        return chunk, time.monotonic() - self.init_time
+
+    def release_read(self):
+        """ Makes a blocking read of the port return at once. """
+        try:
+            self.serialConnection.cancel_read()
+        except (AttributeError, serial.serialutil.SerialException):
+            pass
+
+    def synthetic_block_period(self):
+        return max(1.0 / self.dummy_rate, 0.05)
+
+    def synthetic_block(self, source, next_frame):
+        """ Stores the synthetic frames due from next_frame until now, returns the time of the following frame. """
+        period = 1.0 / self.dummy_rate
+        now = time.monotonic() - self.init_time
+        n_frames = int((now - next_frame) / period) + 1
+        frame_times = next_frame + period * np.arange(n_frames)
+        self.store_frames(source.generate(frame_times), frame_times)
+        return frame_times[-1] + period
+
+    async def background_task(self, engine):
+        """
+        Receives frames as a task of an AcquisitionEngine, trying to reopen the port every reconnect_period while
+        it is not open. Synthetic frames of the 'dummy' port are generated in blocks to keep wake-ups rare.
+        """
+        try:
+            if self.synthetic:
+                source = DummySource(self.n_ai, self.data_type)
+                next_frame = time.monotonic() - self.init_time
+                while True:
+                    await asyncio.sleep(self.synthetic_block_period())
+                    next_frame = self.synthetic_block(source, next_frame)
+            while True:
+                if self.serialConnection is None and not await engine.run_blocking(self.connect, False):
+                    await asyncio.sleep(self.reconnect_period)
+                    continue
+                await self.read_port(engine)
+                self.lose_connection()
+                await asyncio.sleep(self.reconnect_period)
+        finally:
+            self.connected.clear()
+
+    async def read_port(self, engine):
+        """
+        Stores the frames arriving on the open port until the link breaks.
+
+        On POSIX the engine loop is woken when the port has data. Elsewhere the loop cannot watch the port, so the
+        reads block in read_executor, a thread of this port, and the shared workers of the engine stay free.
+        """
+        connection = self.serialConnection
+        self.start_stream()
+        try:
+            file_descriptor = connection.fileno() if os.name == 'posix' else None
+        except (AttributeError, OSError):
+            file_descriptor = None
+        if file_descriptor is None:
+            if self.read_executor is None:
+                self.read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='serial read')
+            while True:
+                try:
+                    chunk, receive_time = await engine.run_blocking(self.read_chunk, connection,
+                                                                    cancel=self.release_read,
+                                                                    executor=self.read_executor)
+                except (AttributeError, TypeError, OSError, serial.serialutil.SerialException):
+                    return
+                self.feed(chunk, receive_time)
+        loop = asyncio.get_running_loop()
+        data_ready = asyncio.Event()
+        loop.add_reader(file_descriptor, data_ready.set)
+        try:
+            while True:
+                await data_ready.wait()
+                data_ready.clear()
                 try:
-                    self.serialConnection.reset_input_buffer()
-                    self.serialConnection.readinto(self.raw_data)
-                    self.is_receiving = True
-                except (AttributeError, serial.serialutil.SerialException):
-                    self.port = 'dummy'
-                    self.is_run = False
-                    self.to_log.emit('<span style=\" color:#ff0000;\" >Lost connection to Arduino. Check connection '
-                                     'and refresh COM ports.</span>')
+                    # readable with nothing queued means the link is gone, pyserial raises on the read then
+                    chunk = connection.read(max(connection.in_waiting, 1))
+                    receive_time = time.monotonic() - self.init_time
+                except (AttributeError, TypeError, OSError, serial.serialutil.SerialException):
+                    return
+                self.feed(chunk, receive_time)
+        finally:
+            loop.remove_reader(file_descriptor)
 
     def close(self):
-        self.is_run = False
-        if self.thread is not None:
-            self.thread.join()
-        if not str(self.port) == 'dummy':
+        if self.read_executor is not None:
+            self.read_executor.shutdown(wait=False)
+            self.read_executor = None
+        if self.serialConnection is not None:
             self.serialConnection.close()
             self.to_log.emit('<span style=\" color:#000000;\" >Disconnected serial port...</span>')
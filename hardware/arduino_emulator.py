@@ -0,0 +1,169 @@
+import argparse
+import numpy as np
+import os
+import threading
+import time
+import tty
+
+from hardware.arduino_ai import DummySource, FRAME_SYNC
+from hardware.sensor import ArduinoSensor
+import utility.conversions as conversions
+
+
+class ArduinoEmulator:
+    """
+    Stand-in for a board running sensor_adc.ino behind a pseudo-terminal (POSIX only).
+
+    Frames of a DummySource are written to the master side of a pty pair at a fixed rate, limited to what the
+    configured baud rate can carry, so that SerialRead and ArduinoSensor can open emulator.port like a real board.
+    Bytes can be dropped at random and the link can be cut with disconnect(). With tag_frames the last channel
+    carries a frame counter instead of irradiance, which lets benchmarks match received frames to send times.
+    """
+    def __init__(self, n_ai=5, data_num_bytes=2, rate=200.0, baud=38400, noise=1.0, drop_rate=0.0,
+                 tag_frames=False, seed=None):
+        self.n_ai = n_ai
+        self.data_type = 'h' if data_num_bytes == 2 else 'f'
+        self.rate = rate  # frames per second
+        self.baud = baud
+        self.drop_rate = drop_rate  # probability of losing each byte
+        self.tag_frames = tag_frames
+        self.source = DummySource(n_ai, self.data_type, noise=noise, seed=seed)
+        self.rng = np.random.default_rng(seed)
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.abort = threading.Event()
+        self.thread = None
+        self.sent_times = []  # monotonic send time of each frame
+        self.bytes_sent = 0
+        self.bytes_dropped = 0
+        self.bytes_overflowed = 0  # bytes lost because nobody drained the port
+
+    def start(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        self.abort.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+        return self.port
+
+    def run(self):
+        period = 1.0 / self.rate
+        byte_period = 10.0 / self.baud  # start bit, 8 data bits, stop bit
+        start_time = next_frame = line_free = time.monotonic()
+        while not self.abort.wait(max(0., max(next_frame, line_free) - time.monotonic())):
+            now = time.monotonic()
+            n_frames = max(1, int((now - next_frame) / period) + 1)
+            frame_times = next_frame + period * np.arange(n_frames)
+            next_frame = frame_times[-1] + period
+            codes = self.source.codes(frame_times - start_time)
+            if self.tag_frames:
+                codes[-1] = (len(self.sent_times) + np.arange(n_frames)) % 2**15
+            frames = np.frombuffer(FRAME_SYNC * n_frames, dtype=np.uint8).reshape(n_frames, -1)
+            block = np.hstack([frames, codes.T.copy().view(np.uint8).reshape(n_frames, -1)]).ravel()
+            if self.drop_rate > 0:
+                keep = self.rng.random(block.size) >= self.drop_rate
+                self.bytes_dropped += block.size - int(keep.sum())
+                block = block[keep]
+            try:
+                written = os.write(self.master, block.tobytes())
+            except BlockingIOError:
+                written = 0
+            except OSError:  # disconnected
+                return
+            self.bytes_overflowed += block.size - written
+            self.bytes_sent += written
+            self.sent_times.extend([time.monotonic()] * n_frames)
+            line_free = max(line_free, now) + written * byte_period
+
+    def disconnect(self):
+        """ Cuts the link as if the USB cable was pulled, readers of the port get an I/O error. """
+        self.abort.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    def stop(self):
+        self.disconnect()
+
+
+def frame_counters(values):
+    """ Recovers the frame counters of tagged frames from the converted last channel of SerialRead.frames. """
+    codes = conversions.voltage_to_digital(conversions.power_to_voltage(values), bits=15, voltage_range=6.144)
+    counters = np.round(codes).astype(np.int64)
+    wraps = np.cumsum(np.diff(counters, prepend=counters[:1]) < 0)
+    return counters + wraps * 2**15
+
+
+def benchmark(baud=38400, rate=200.0, duration=10.0, noise=1.0, drop_rate=0.0, n_ai=5, data_num_bytes=2):
+    """
+    Streams tagged frames from an emulator into an ArduinoSensor and reports throughput, latency, the time to
+    notice a pulled cable and the time to receive data again on a fresh connection.
+    """
+    emulator = ArduinoEmulator(n_ai, data_num_bytes, rate, baud, noise, drop_rate, tag_frames=True)
+    port = emulator.start()
+    sensor = ArduinoSensor(port=port, baud=baud, data_num_bytes=data_num_bytes, n_ai=n_ai,
+                           n_frames=int(rate * duration * 2) + 1000)
+    sensor.start()
+    sensor.wait_ready(30)
+    ser = sensor.ser
+    first_frame = ser.frames_received
+    t_start = time.monotonic()
+    time.sleep(duration)
+    elapsed = time.monotonic() - t_start
+    received = ser.frames_received - first_frame
+
+    times, values = ser.frames.get_times(), ser.frames.get_values(n_ai - 1)
+    counters = frame_counters(values)
+    counters += (len(emulator.sent_times) - 1 - counters[-1]) // 2**15 * 2**15  # align with the send counter
+    sent_times = np.asarray(emulator.sent_times)
+    valid = (counters >= 0) & (counters < sent_times.size)
+    latencies = (times[valid] + ser.init_time) - sent_times[counters[valid]]
+    expected = counters[-1] - counters[0] + 1
+
+    t_cut = time.monotonic()
+    emulator.disconnect()
+    while ser.connected.is_set() and time.monotonic() - t_cut < 10:
+        time.sleep(0.001)
+    detect_time = time.monotonic() - t_cut
+    sensor.stop()
+
+    port = emulator.start()
+    t_reconnect = time.monotonic()
+    sensor = ArduinoSensor(port=port, baud=baud, data_num_bytes=data_num_bytes, n_ai=n_ai)
+    sensor.start()
+    sensor.wait_ready(30)
+    reconnect_time = time.monotonic() - t_reconnect
+    sensor.stop()
+    emulator.stop()
+
+    return {'frames per second': received / elapsed,
+            'samples per second': received * n_ai / elapsed,
+            'frame loss (%)': 100. * (1 - len(counters) / expected) if expected > 0 else 0.,
+            'bytes discarded': ser.bytes_discarded,
+            'bytes dropped by emulator': emulator.bytes_dropped,
+            'bytes overflowed': emulator.bytes_overflowed,
+            'mean latency (ms)': 1e3 * float(np.mean(latencies)),
+            'max latency (ms)': 1e3 * float(np.max(latencies)),
+            'disconnect detected after (s)': detect_time,
+            'reconnected after (s)': reconnect_time}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark SerialRead and ArduinoSensor against an emulated board.')
+    parser.add_argument('--baud', type=int, default=38400)
+    parser.add_argument('--rate', type=float, default=200.0, help='frames per second')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds')
+    parser.add_argument('--noise', type=float, default=1.0)
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='probability of dropping each byte')
+    parser.add_argument('--bytes', type=int, default=2, choices=[2, 4], help='bytes per value')
+    args = parser.parse_args()
+    results = benchmark(args.baud, args.rate, args.duration, args.noise, args.drop_rate, data_num_bytes=args.bytes)
+    for key, value in results.items():
+        print('%s: %.3f' % (key, value))
@@ -0,0 +1,143 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import traceback
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+class EngineTask:
+    """ Handle of a coroutine running on an AcquisitionEngine, usable from any thread. """
+    def __init__(self, loop, thread, coroutine):
+        self.loop = loop
+        self.thread = thread  # engine thread running the loop
+        self.task = None
+        self.error = None
+        self.finished = threading.Event()
+        self.loop.call_soon_threadsafe(self.create, coroutine)
+
+    def create(self, coroutine):
+        self.task = self.loop.create_task(coroutine)
+        self.task.add_done_callback(self.task_done)
+
+    def task_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.error = task.exception()
+            traceback.print_exception(type(self.error), self.error, self.error.__traceback__)
+        self.finished.set()
+
+    def cancel(self):
+        """ Cancels the coroutine at its next await, cleanup code of the coroutine still runs. """
+        self.loop.call_soon_threadsafe(self.cancel_task)
+
+    def cancel_task(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def wait(self, timeout=None):
+        """ Blocks until the coroutine has finished, returns False if timeout passed first. """
+        if threading.current_thread() is self.thread:
+            return self.finished.is_set()  # waiting on the engine thread would block the coroutine itself
+        return self.finished.wait(timeout)
+
+    def done(self):
+        return self.finished.is_set()
+
+
+class AcquisitionEngine:
+    """
+    One asyncio event loop in one thread that runs the acquisition coroutines of all instruments.
+
+    Drivers submit their main coroutine with submit() and await asyncio.sleep for settling and polling, so timing
+    is set by the loop clock and cancelling a task aborts at the next await instead of after the next sleep. Calls
+    into blocking libraries (pyvisa, pyserial) go through run_blocking, which uses a small shared pool of worker
+    threads. The number of threads therefore stays fixed no matter how many instruments are running.
+    """
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.loop = None
+        self.thread = None
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='engine worker')
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.run, name='engine', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def submit(self, coroutine):
+        """ Schedules coroutine on the engine loop, returns an EngineTask. """
+        self.start()
+        return EngineTask(self.loop, self.thread, coroutine)
+
+    async def run_blocking(self, function, *args, cancel=None, executor=None):
+        """
+        Runs a blocking call on the worker pool, or on executor if given, and returns its result.
+
+        A cancelled caller still waits for the call to return before the cancellation is raised, so that cleanup
+        code never talks to an instrument while a previous transaction is in flight. cancel, if given, is called
+        first to make a call return that would otherwise block for long. Calls that block for long belong on an
+        executor of their own, so that they never keep the shared workers from other instruments.
+        """
+        future = self.loop.run_in_executor(executor or self.executor, function, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if cancel is not None:
+                cancel()
+            await asyncio.wait([future])
+            raise
+
+    def stop(self, timeout=5.0):
+        """ Cancels all tasks and stops the loop and the worker pool. """
+        with self.lock:
+            if self.thread is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout)
+            self.executor.shutdown(wait=False)
+            self.thread = None
+            self.loop = None
+            self.executor = None
+
+
+def get_engine():
+    """ Engine shared by all instruments of the application, started on first use. """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AcquisitionEngine()
+        _engine.start()
+        return _engine
+
+
+async def periodic(period):
+    """
+    Yields the loop time of every tick of a fixed-rate clock with the given period.
+
+    Ticks are scheduled from the start time rather than from the previous wake-up, so they do not drift; ticks
+    missed while the consumer was busy are skipped.
+    """
+    loop = asyncio.get_running_loop()
+    tick = loop.time()
+    while True:
+        tick += period
+        now = loop.time()
+        if tick < now:
+            tick += (now - tick) // period * period + period
+        await asyncio.sleep(tick - now)
+        yield tick
@@ -1,23 +1,43 @@
+import asyncio
 import numpy as np
+import os
 import pandas as pd
 import pyqtgraph as pg
 from pymeasure.instruments.keithley import Keithley2400
 from PyQt5 import QtCore
 import pyvisa
-import threading
 import time
 
+from hardware.engine import get_engine
+from hardware.keithley_sim import SimulatedKeithley2400, SIM_PORT
+from utility import decimate, sweep_planner
+from utility.trace_writer import TraceWriter
+
+MAX_BUFFER_READINGS = 2500  # trace buffer size of the 2400
+MAX_LIST_POINTS = 100  # longest source list of the 2400
+MAX_FILTER_COUNT = 100  # most readings the averaging filter of the 2400 combines
+READING_TIME = 0.02  # duration of one reading at 1 NPLC and 50 Hz
+PHASES = ('write', 'settle', 'trigger', 'wait', 'read')  # steps of a point-by-point measurement
+N_SENSOR_CHANNELS = 5  # thermistor and four irradiance diodes
+IV_COLUMNS = ['Time (s)', 'Voltage (V)', 'Current (A)', 'Current Std (A)', 'Resistance (Ohm)', 'Power (W)']
+
+
+def sensor_columns(n_channels=N_SENSOR_CHANNELS):
+    """ Column names of the sensor channels in saved IV curves. """
+    return ['Temperature (C)'] + ['Irradiance %d (W/m2)' % channel for channel in range(1, n_channels)]
+
 
 class Keithley(QtCore.QObject):
     update = QtCore.pyqtSignal(int)
     save_settings = QtCore.pyqtSignal()
-    restart_sensor = QtCore.pyqtSignal()
     save = QtCore.pyqtSignal(int)
     to_log = QtCore.pyqtSignal(str)
     end_of_experiment = QtCore.pyqtSignal()
 
     def __init__(self, gpib_port='GPIB::24', n_data_points=100, averages=5, repetitions=1, repetition_delay=2.0,
-                 delay=0.25, experiment_delay=1.0, min_voltage=-0.01, max_voltage=0.7, compliance_current=0.5):
+                 delay=0.25, experiment_delay=1.0, min_voltage=-0.01, max_voltage=0.7, compliance_current=0.5,
+                 sim_settings=None, hardware_sweep=False, adaptive=False, reference=None, sensor=None,
+                 sensor_timeout=5.0, engine=None, binary_traces=False):
         super(Keithley, self).__init__()
         self.gpib_port = gpib_port
         self.n_data_points = n_data_points
@@ -29,25 +49,49 @@ class Keithley(QtCore.QObject):
         self.max_voltage = max_voltage
         self.min_voltage = min_voltage
         self.compliance_current = compliance_current
-        self.voltages_set = np.linspace(self.min_voltage, self.max_voltage, num=self.n_data_points)
+        self.hardware_sweep = hardware_sweep  # let the instrument run the sweep and read all points at the end
+        self.sensor = sensor  # ArduinoSensor whose readings tag the curves, waited for before each curve
+        self.sensor_timeout = sensor_timeout
+        self.sim_settings = sim_settings or {}  # keyword arguments of SimulatedKeithley2400 for the 'sim' port
+        self.adaptive = adaptive  # place the points of each curve according to the previous one
+        self.planned_points = n_data_points
+        self.reference = reference  # (voltages, currents) of the previous curve of the same film
+        self.engine = engine  # AcquisitionEngine that runs the scan, the shared one of get_engine by default
+        self.set_voltages(np.linspace(self.min_voltage, self.max_voltage, num=self.n_data_points))
+
+        self.is_run = True
+        # self.is_receiving = False
+        self.task = None
+        self.sourcemeter = None
+        self.sweep_clock = 0.
+        self.trace_directory = None  # folder the curves are written to as IV_Curve_<repetition>.csv while measured
+        self.trace_writer = None
+        self.binary_traces = binary_traces  # store written curves in the binary trace format as well
+
+    def set_voltages(self, voltages):
+        """ Replaces the voltages of the next sweep and resizes the result arrays to match. """
+        self.voltages_set = np.asarray(voltages, dtype=float)
+        self.n_data_points = self.voltages_set.size
         self.times = np.zeros_like(self.voltages_set)
         self.voltages = np.zeros_like(self.voltages_set)
         self.currents = np.zeros_like(self.voltages_set)
         self.currents_std = np.zeros_like(self.voltages_set)
         self.resistances = np.zeros_like(self.voltages_set)
         self.powers = np.zeros_like(self.voltages_set)
-
-        self.is_run = True
-        # self.is_receiving = False
-        self.gpib_thread = None
-        self.sourcemeter = None
+        n_channels = self.sensor.n_ai if self.sensor is not None else N_SENSOR_CHANNELS
+        self.sensor_data = np.full((n_channels, self.n_data_points), -1.)  # sensor readings of each point
+        self.phase_times = np.zeros((self.n_data_points, len(PHASES)))
+        self.point_windows = np.zeros((self.n_data_points, 2))  # monotonic start and end of each measurement
 
     def config_keithley(self, **kwargs):
         self.to_log.emit('<span style=\" color:#000000;\" >Trying to connect to: ' + str(self.gpib_port) + '.</span>')
         if str(self.gpib_port) == 'dummy':
             return
         try:
-            self.sourcemeter = Keithley2400(str(self.gpib_port))
+            if str(self.gpib_port) == SIM_PORT:
+                self.sourcemeter = Keithley2400(SimulatedKeithley2400(**self.sim_settings))
+            else:
+                self.sourcemeter = Keithley2400(str(self.gpib_port))
             self.to_log.emit('<span style=\" color:#32cd32;\" >Connected to ' + str(self.gpib_port) + '.</span>')
         except pyvisa.errors.VisaIOError:
             self.to_log.emit('<span style=\" color:#ff0000;\" >Failed to connect with ' + str(self.gpib_port) +
@@ -68,75 +112,308 @@ class Keithley(QtCore.QObject):
 
     def read_keithley_start(self):
         self.is_run = True
-        # self.is_receiving = False
-        if self.gpib_thread is None:
-            self.gpib_thread = threading.Thread(target=self.background_thread)
-            self.gpib_thread.start()
-            # # Block till we start receiving values
-            # while not self.is_receiving:
-            #     time.sleep(0.1)
+        if self.engine is None:
+            self.engine = get_engine()
+        if self.task is None:
+            self.task = self.engine.submit(self.background_task())
 
     def get_keithley_data(self):
-        data = pd.DataFrame({
-            'Time (s)': self.times,
-            'Voltage (V)': self.voltages,
-            'Current (A)': self.currents,
-            'Current Std (A)': self.currents_std,
-            'Resistance (Ohm)': self.resistances,
-            'Power (W)': self.powers})
+        data = pd.DataFrame(dict(zip(IV_COLUMNS, self.keithley_arrays())))
+        return data
+
+    def keithley_arrays(self):
+        return [self.times, self.voltages, self.currents, self.currents_std, self.resistances, self.powers]
+
+    def get_curve_data(self):
+        """ IV data of the last curve with the sensor readings of each point, as saved to IV_Curve_*.csv. """
+        data = self.get_keithley_data()
+        for column, values in zip(sensor_columns(self.sensor_data.shape[0]), self.sensor_data):
+            data[column] = values
         return data
 
-    def background_thread(self):  # retrieve data
-        time.sleep(1.0)  # give some buffer time for retrieving data
-        time.sleep(self.experiment_delay)  # pause between experiments
-        self.config_keithley()
-        while self.is_run:
-            self.save_settings.emit()
+    async def background_task(self):
+        """
+        Measures repetitions curves as a task of the engine, cancelling the task aborts at the next await.
+
+        With adaptive the points are placed once per experiment, along the last curve of the previous experiment
+        or a coarse curve, so that all curves of the experiment share one voltage grid and average point by point.
+        Slots of save_settings and save run on the worker pool, as they are connected directly in a Rig.
+        """
+        run_blocking = self.engine.run_blocking
+        try:
+            await asyncio.sleep(self.experiment_delay)  # pause between experiments
+            await run_blocking(self.config_keithley)
+            await run_blocking(self.save_settings.emit)
+            if self.adaptive:
+                if self.reference is None:
+                    self.prepare_coarse_sweep()
+                    await self.measure_curve()
+                    self.reference = (self.voltages_set.copy(), self.currents.copy())
+                self.apply_plan()
             for repetition in range(self.repetitions):
-                self.restart_sensor.emit()
-                time.sleep(5.0)  # give time for sensor connection to re-establish itself
-                if str(self.gpib_port) == 'dummy':
-                    for dp in range(self.n_data_points):
-                        if not self.is_run:
-                            self.to_log.emit('<span style=\" color:#ff0000;\" >Scan aborted.</span>')
-                            return
-                        time.sleep(self.delay)
-                        self.times[dp] = time.time()
-                        self.update.emit(dp)
-                        # self.is_receiving = True
-                else:
-                    for dp in range(self.n_data_points):
-                        if not self.is_run:
-                            self.to_log.emit('<span style=\" color:#ff0000;\" >Scan aborted.</span>')
-                            return
-                        self.sourcemeter.adapter.write(":TRAC:FEED:CONT NEXT;")
-                        self.sourcemeter.source_voltage = self.voltages_set[dp]
-                        time.sleep(self.delay)
-                        self.sourcemeter.start_buffer()
-                        self.sourcemeter.wait_for_buffer()
-                        self.times[dp] = time.time()
-                        self.voltages[dp] = self.sourcemeter.mean_voltage
-                        self.currents[dp] = - self.sourcemeter.mean_current
-                        self.currents_std[dp] = self.sourcemeter.std_current
-                        self.resistances[dp] = abs(self.voltages[dp] / self.currents[dp])
-                        self.powers[dp] = abs(self.voltages[dp] * self.currents[dp])
-                        self.update.emit(dp)
-                        # self.is_receiving = True
-                    self.sourcemeter.source_voltage = 0
-                self.save.emit(repetition)
+                await self.await_sensor()
+                await run_blocking(self.open_trace, repetition)
+                await self.measure_curve()
+                await run_blocking(self.close_trace)
+                if self.adaptive:  # reference of the next experiment
+                    self.reference = (self.voltages_set.copy(), self.currents.copy())
+                await run_blocking(self.save.emit, repetition)
                 self.to_log.emit('<span style=\" color:#1e90ff;\" >Finished curve #%s</span>' % str(repetition + 1))
                 if repetition < self.repetitions - 1:
-                    time.sleep(self.repetition_delay)
+                    await asyncio.sleep(self.repetition_delay)
                 else:
                     self.to_log.emit('<span style=\" color:#32cd32;\" >Finished IV scan.</span>')
+        except asyncio.CancelledError:
+            self.to_log.emit('<span style=\" color:#ff0000;\" >Scan aborted.</span>')
+            await run_blocking(self.close_trace, False)  # completes even if cancelled once more
+            raise
+        finally:
             self.is_run = False
         self.end_of_experiment.emit()
 
+    async def await_sensor(self):
+        """ Waits until the sensor delivers data, so that the curve is tagged with live readings. """
+        if self.sensor is None:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.sensor_timeout
+        failed_connects = None
+        while loop.time() < deadline and not self.sensor.abort.is_set():
+            ser = self.sensor.ser
+            if ser is not None:
+                if ser.connected.is_set():
+                    return
+                if failed_connects is None:
+                    failed_connects = ser.failed_connects
+                elif ser.failed_connects > failed_connects:
+                    break
+            await asyncio.sleep(0.01)
+        self.to_log.emit('<span style=\" color:#ff8c00;\" >Sensor not ready, measuring curve without live '
+                         'sensor data.</span>')
+
+    async def measure_curve(self):
+        async for _ in self.sweep_points():
+            pass
+
+    async def sweep_points(self):
+        """ Measures one IV curve, yielding the index of every point once it is stored. """
+        run_blocking = self.engine.run_blocking
+        if str(self.gpib_port) == 'dummy':
+            for dp in range(self.n_data_points):
+                start = time.monotonic()
+                await asyncio.sleep(self.delay)
+                self.times[dp] = time.time()
+                self.point_windows[dp] = start, time.monotonic()
+                self.tag_sensor(dp)
+                await run_blocking(self.journal_point, dp)
+                self.update.emit(dp)
+                yield dp
+            self.align_sensor()
+            return
+        if self.hardware_sweep:
+            source_command = self.sweep_source_command()
+            if source_command is not None:
+                start_time = await run_blocking(self.start_instrument_sweep, source_command)
+                duration = self.instrument_sweep_duration()
+                try:
+                    await self.await_buffer(duration, interval=0.1, timeout=10. + duration)
+                except asyncio.CancelledError:
+                    await run_blocking(self.finish_instrument_sweep, start_time, False)
+                    raise
+                await run_blocking(self.finish_instrument_sweep, start_time, True)
+                for dp in range(self.n_data_points):
+                    yield dp
+                return
+            self.to_log.emit('<span style=\" color:#ff8c00;\" >Sweep does not fit into the instrument buffer, '
+                             'measuring point by point.</span>')
+        for dp in range(self.n_data_points):
+            phase_start = time.monotonic()
+            await run_blocking(self.write_point, dp)
+            write_end = time.monotonic()
+            await asyncio.sleep(self.delay)
+            settle_end = time.monotonic()
+            await run_blocking(self.sourcemeter.start_buffer)
+            trigger_end = time.monotonic()
+            await self.await_buffer(self.averages * READING_TIME)
+            wait_end = time.monotonic()
+            self.times[dp] = time.time()
+            means, standard_devs = await run_blocking(self.read_statistics)
+            self.phase_times[dp] = np.diff([phase_start, write_end, settle_end, trigger_end, wait_end,
+                                            time.monotonic()])
+            self.point_windows[dp] = settle_end, wait_end
+            self.store_point(dp, means, standard_devs)
+            await run_blocking(self.journal_point, dp)
+            self.update.emit(dp)
+            yield dp
+        await run_blocking(self.finish_point_sweep)
+
+    async def await_buffer(self, duration, interval=0.005, timeout=60.):
+        """
+        Waits for the buffer to fill. The bus stays quiet for the expected duration of the measurement, then the
+        status byte is polled every interval seconds.
+        """
+        await asyncio.sleep(duration)
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not await self.engine.run_blocking(self.sourcemeter.is_buffer_full):
+            if asyncio.get_running_loop().time() > deadline:
+                raise Exception("Timed out waiting for Keithley buffer to fill.")
+            await asyncio.sleep(interval)
+
+    def open_trace(self, repetition):
+        """ Starts journaling the points of the next curve to disk, if a trace_directory is set. """
+        if self.trace_directory is not None:
+            self.trace_writer = TraceWriter(os.path.join(self.trace_directory, 'IV_Curve_%d.csv' % repetition),
+                                            IV_COLUMNS + sensor_columns(self.sensor_data.shape[0]),
+                                            binary=self.binary_traces)
+
+    def close_trace(self, complete=True):
+        """ Writes the finished curve, or keeps the points of an interrupted one in the journal. """
+        if self.trace_writer is None:
+            return
+        if complete:
+            self.trace_writer.finish(self.get_curve_data())
+        else:
+            self.trace_writer.close()
+        self.trace_writer = None
+
+    def journal_point(self, dp):
+        """ Appends point dp to the curve being written, if any. Writes to disk, so engine tasks use run_blocking. """
+        if self.trace_writer is not None:
+            self.trace_writer.append(dp, [array[dp] for array in self.keithley_arrays()] +
+                                     list(self.sensor_data[:, dp]))
+
+    def announce_point(self, dp):
+        """ Journals point dp and tells listeners that it is measured. """
+        self.journal_point(dp)
+        self.update.emit(dp)
+
+    def tag_sensor(self, dp):
+        """ Stores the sensor readings averaged over the measurement window of point dp with the point. """
+        if self.sensor is None:
+            return
+        readings = self.sensor.get_sensor_window(*self.point_windows[dp])
+        if len(readings) != self.sensor_data.shape[0]:
+            self.sensor_data = np.full((len(readings), self.n_data_points), -1.)
+        self.sensor_data[:, dp] = readings
+
+    def align_sensor(self):
+        """ Tags all points again once the sweep is done, to include frames that arrived after their point. """
+        for dp in range(self.n_data_points):
+            self.tag_sensor(dp)
+
+    def tag_readings(self, reading_times):
+        """
+        Stores the sensor readings of an instrument sweep, reading_times are the monotonic times of the readings
+        with the shape (averages, n_data_points). Each point gets the readings interpolated at its readings and
+        averaged over them.
+        """
+        self.point_windows[:] = np.column_stack([reading_times.min(axis=0), reading_times.max(axis=0)])
+        if self.sensor is None:
+            return
+        readings = self.sensor.get_sensor_at(reading_times.ravel())
+        self.sensor_data = readings.reshape(-1, *reading_times.shape).mean(axis=1)
+
+    def prepare_coarse_sweep(self):
+        self.to_log.emit('<span style=\" color:#000000;\" >Measuring coarse curve for sweep planning.</span>')
+        self.set_voltages(sweep_planner.coarse_voltages(self.min_voltage, self.max_voltage, self.planned_points))
+
+    def apply_plan(self):
+        self.set_voltages(sweep_planner.plan_voltages(*self.reference, self.planned_points,
+                                                      self.min_voltage, self.max_voltage))
+
+    def write_point(self, dp):
+        self.sourcemeter.adapter.write(':TRAC:FEED:CONT NEXT;:SOUR:VOLT:LEV %g;' % self.voltages_set[dp])
+
+    def store_point(self, dp, means, standard_devs):
+        """ Stores the buffer statistics of point dp with the sensor readings. """
+        self.voltages[dp] = means[0]
+        self.currents[dp] = - means[1]
+        self.currents_std[dp] = standard_devs[1]
+        self.resistances[dp] = abs(self.voltages[dp] / self.currents[dp])
+        self.powers[dp] = abs(self.voltages[dp] * self.currents[dp])
+        self.tag_sensor(dp)
+
+    def finish_point_sweep(self):
+        self.sourcemeter.source_voltage = 0
+        self.align_sensor()
+        self.to_log.emit('<span style=\" color:#000000;\" >Mean point timing (ms): %s</span>' %
+                         ', '.join('%s %.1f' % (phase, 1e3 * duration)
+                                   for phase, duration in zip(PHASES, self.phase_times.mean(axis=0))))
+
+    def read_statistics(self):
+        """ Means and standard deviations of voltage, current and resistance over the buffer, in one query. """
+        reply = self.sourcemeter.adapter.ask(':CALC3:FORM MEAN;:CALC3:DATA?;:CALC3:FORM SDEV;:CALC3:DATA?;')
+        values = np.array(reply.strip().replace(';', ',').split(','), dtype=float)
+        return values[:3], values[3:6]
+
+    def get_phase_timing(self):
+        """ Durations of the phases of each point of the last point-by-point sweep. """
+        return pd.DataFrame(self.phase_times, columns=['%s (s)' % phase.capitalize() for phase in PHASES])
+
+    def sweep_source_command(self):
+        """ SCPI that programs voltages_set as an instrument sweep, None if the 2400 cannot hold the sweep. """
+        if self.n_data_points > MAX_BUFFER_READINGS or self.averages > MAX_FILTER_COUNT:
+            return None
+        steps = np.diff(self.voltages_set)
+        if steps.size == 0 or np.allclose(steps, steps[0]):
+            return (':SOUR:VOLT:MODE SWE;:SOUR:SWE:SPAC LIN;:SOUR:SWE:RANG AUTO;:SOUR:VOLT:STAR %g;'
+                    ':SOUR:VOLT:STOP %g;:SOUR:SWE:POIN %d;' % (self.voltages_set[0], self.voltages_set[-1],
+                                                               self.n_data_points))
+        if self.n_data_points <= MAX_LIST_POINTS:
+            return ':SOUR:VOLT:MODE LIST;:SOUR:LIST:VOLT %s;' % ','.join('%g' % v for v in self.voltages_set)
+        return None
+
+    def instrument_sweep_duration(self):
+        return self.n_data_points * (self.delay + self.averages * READING_TIME)
+
+    def start_instrument_sweep(self, source_command):
+        """
+        Programs and triggers a sweep that runs the whole curve on the instrument, returns the time it started.
+
+        The repeat filter of the instrument averages the readings of each point, so every point settles once for
+        delay seconds. Only the averages reach the buffer, so no current standard deviation is recorded (NaN).
+        """
+        adapter = self.sourcemeter.adapter
+        adapter.write(':SOUR:FUNC VOLT;' + source_command +
+                      ':SOUR:DEL %g;:TRIG:COUN %d;:SENS:AVER:TCON REP;:SENS:AVER:COUN %d;:SENS:AVER ON;'
+                      ':FORM:ELEM VOLT,CURR,TIME;' % (self.delay, self.n_data_points, self.averages))
+        adapter.write(':TRAC:CLEAR;:TRAC:POIN %d;:TRAC:FEED SENSE;:TRAC:FEED:CONT NEXT;:SYST:TIME:RES;' %
+                      self.n_data_points)
+        self.sweep_clock = time.monotonic()  # reading time stamps count from here
+        start_time = time.time()
+        self.sourcemeter.start_buffer()
+        return start_time
+
+    def finish_instrument_sweep(self, start_time, complete):
+        """ Fetches a complete buffer or aborts the sweep, restores point-by-point operation. """
+        adapter = self.sourcemeter.adapter
+        if complete:
+            readings = self.sourcemeter.buffer_data.reshape(self.n_data_points, 3)
+        else:
+            self.sourcemeter.stop_buffer()
+        adapter.write(':SOUR:VOLT:MODE FIX;:SOUR:DEL:AUTO ON;:SENS:AVER OFF;:FORM:ELEM CURR;')
+        self.sourcemeter.config_buffer(self.averages)
+        self.sourcemeter.source_voltage = 0
+        if not complete:
+            return False
+        self.times[:] = start_time + readings[:, 2]
+        self.voltages[:] = readings[:, 0]
+        self.currents[:] = - readings[:, 1]
+        self.currents_std[:] = np.nan  # the filter keeps only the mean of each point
+        self.resistances[:] = np.abs(self.voltages / self.currents)
+        self.powers[:] = np.abs(self.voltages * self.currents)
+        averaged = READING_TIME * np.arange(self.averages - 1, -1, -1)[:, np.newaxis]  # before each time stamp
+        self.tag_readings(self.sweep_clock + readings[:, 2] - averaged)
+        for dp in range(self.n_data_points):
+            self.announce_point(dp)
+        return True
+
     def close(self):
         self.is_run = False
-        if self.gpib_thread is not None:
-            self.gpib_thread.join()
-        if not str(self.gpib_port) == 'dummy':
+        if self.task is not None:
+            self.task.cancel()
+            self.task.wait()
+        if not str(self.gpib_port) == 'dummy' and self.sourcemeter is not None:
             self.sourcemeter.shutdown()
             self.to_log.emit('<span style=\" color:#000000;\" >Disconnected Keithley...</span>')
 
@@ -148,4 +425,4 @@ class Keithley(QtCore.QObject):
             xval, yval = [], []
         else:
             xval, yval = self.voltages_set, self.currents
-        target_line.setData(xval, yval)
+        decimate.set_data(target_line, xval, yval)
@@ -0,0 +1,233 @@
+import argparse
+import numpy as np
+from pymeasure.adapters.adapter import Adapter
+import time
+
+SIM_PORT = 'sim'  # port name that makes Keithley use the simulated instrument
+
+
+class SimulatedKeithley2400(Adapter):
+    """
+    In-process stand-in for a Keithley 2400 sourcing voltage into a solar cell.
+
+    Answers the SCPI commands sent by Keithley2400 in config_keithley, background_task and shutdown. Currents
+    follow the single diode model i = iph - i0 * (exp(v / (n * vt)) - 1) - v / rsh, with Gaussian noise and the
+    compliance limit applied, and are reported with the sign convention of the instrument (current flowing into
+    the cell). Every bus transaction (write or read) costs latency seconds, and filling the buffer takes the
+    integration time of the configured number of readings.
+    """
+    def __init__(self, iph=0.05, i0=1e-9, ideality=1.5, rsh=1000., current_noise=1e-5, voltage_noise=1e-5,
+                 latency=0.005, seed=None, **kwargs):
+        super(SimulatedKeithley2400, self).__init__(**kwargs)
+        self.iph = iph
+        self.i0 = i0
+        self.ideality = ideality
+        self.rsh = rsh
+        self.current_noise = current_noise
+        self.voltage_noise = voltage_noise
+        self.latency = latency
+        self.rng = np.random.default_rng(seed)
+        self.transactions = 0
+        self.responses = []
+        self.errors = []
+        self.reset()
+
+    def reset(self):
+        self.source_voltage = 0.
+        self.output = False
+        self.compliance_current = 1.05e-4
+        self.nplc = 1.
+        self.source_mode = 'FIX'
+        self.sweep_start = 0.
+        self.sweep_stop = 0.
+        self.sweep_points = 2501
+        self.list_voltages = np.zeros(1)
+        self.source_delay = 0.
+        self.arm_count = 1
+        self.trigger_count = 1
+        self.trigger_delay = 0.
+        self.filter_count = 1
+        self.filter_on = False
+        self.buffer_points = 1
+        self.elements = ['VOLT', 'CURR', 'RES', 'TIME', 'STAT']
+        self.buffer = np.zeros((0, 4))
+        self.calc_form = 'MEAN'
+        self.buffer_ready_time = None
+        self.time_reset = time.monotonic()
+
+    def diode_current(self, voltage):
+        """ Current delivered by the cell at the given terminal voltage (A). """
+        thermal_voltage = 0.025693
+        return self.iph - self.i0 * (np.exp(voltage / (self.ideality * thermal_voltage)) - 1) - voltage / self.rsh
+
+    def source_voltages(self, n_readings):
+        """ Voltages sourced for consecutive triggers, sweeps advance by one point per trigger. """
+        if self.source_mode == 'SWE':
+            sweep = np.linspace(self.sweep_start, self.sweep_stop, self.sweep_points)
+        elif self.source_mode == 'LIS':
+            sweep = self.list_voltages
+        else:
+            sweep = np.array([self.source_voltage])
+        return sweep[np.arange(n_readings) % self.trigger_count % sweep.size]
+
+    def measure(self, n_readings):
+        """ Readings with the columns voltage, current, resistance and time stamp, filtered if the filter is on. """
+        count = self.readings_per_trigger()
+        voltages = self.source_voltages(n_readings) + self.rng.normal(0, self.voltage_noise, (count, n_readings))
+        if not self.output:
+            voltages[:] = 0.
+        currents = - self.diode_current(voltages) + self.rng.normal(0, self.current_noise, (count, n_readings))
+        currents = np.clip(currents, -self.compliance_current, self.compliance_current)
+        voltages, currents = voltages.mean(axis=0), currents.mean(axis=0)
+        with np.errstate(divide='ignore'):
+            resistances = voltages / currents
+        stamps = time.monotonic() - self.time_reset + self.integration_time(np.arange(1, n_readings + 1))
+        return np.column_stack([voltages, currents, resistances, stamps])
+
+    def readings_per_trigger(self):
+        return self.filter_count if self.filter_on else 1
+
+    def integration_time(self, n_readings):
+        return n_readings * (self.readings_per_trigger() * self.nplc / 50. + self.trigger_delay + self.source_delay)
+
+    def write(self, command):
+        time.sleep(self.latency)
+        self.transactions += 1
+        replies = [self.execute(part.strip()) for part in command.split(';') if part.strip()]
+        replies = [reply for reply in replies if reply is not None]
+        if replies:
+            self.responses.append(';'.join(replies))
+
+    def read(self):
+        time.sleep(self.latency)
+        self.transactions += 1
+        return self.responses.pop(0) if self.responses else ''
+
+    def execute(self, command):
+        """ Executes a single SCPI command, returns the reply of queries and None otherwise. """
+        header, _, argument = command.partition(' ')
+        header = header.upper().lstrip(':')
+        argument = argument.strip().strip("'\"").upper()
+        if header == '*RST':
+            self.reset()
+        elif header == '*IDN?':
+            return 'KEITHLEY INSTRUMENTS INC.,MODEL 2400,SIMULATED,C30'
+        elif header == '*STB?':
+            full = (self.buffer_ready_time is not None and time.monotonic() >= self.buffer_ready_time
+                    and len(self.buffer) >= self.buffer_points)
+            return '65' if full else '0'
+        elif header in ('SYSTEM:ERROR?', 'SYST:ERR?'):
+            return self.errors.pop(0) if self.errors else '0,"No error"'
+        elif header in ('OUTPUT', 'OUTP'):
+            self.output = argument in ('ON', '1')
+        elif header == 'SOUR:FUNC?':
+            return 'VOLT'
+        elif header == 'SOUR:VOLT:MODE':
+            self.source_mode = argument[:3]
+        elif header == 'SOUR:VOLT:STAR':
+            self.sweep_start = float(argument)
+        elif header == 'SOUR:VOLT:STOP':
+            self.sweep_stop = float(argument)
+        elif header == 'SOUR:SWE:POIN':
+            self.sweep_points = int(float(argument))
+        elif header == 'SOUR:LIST:VOLT':
+            self.list_voltages = np.array([float(value) for value in argument.split(',')])
+        elif header == 'SOUR:DEL':
+            self.source_delay = float(argument)
+        elif header == 'SOUR:DEL:AUTO':
+            self.source_delay = 0.
+        elif header == 'SOUR:VOLT:LEV':
+            self.source_voltage = float(argument)
+        elif header == 'SOUR:VOLT?':
+            return '%g' % self.source_voltage
+        elif header == 'SENS:CURR:PROT':
+            self.compliance_current = float(argument)
+        elif header == 'SENS:CURR:NPLC':
+            self.nplc = float(argument)
+        elif header == 'TRIG:COUN':
+            self.trigger_count = int(float(argument))
+        elif header == 'ARM:COUN':
+            self.arm_count = int(float(argument))
+        elif header == 'SENS:AVER:COUN':
+            self.filter_count = int(float(argument))
+        elif header == 'SENS:AVER':
+            self.filter_on = argument in ('ON', '1')
+        elif header == 'TRAC:POIN':
+            self.buffer_points = int(float(argument))
+        elif header == 'FORM:ELEM':
+            self.elements = [element.strip() for element in argument.split(',')]
+        elif header == 'SYST:TIME:RES':
+            self.time_reset = time.monotonic()
+        elif header == 'TRIG:SEQ:DEL':
+            self.trigger_delay = float(argument)
+        elif header == 'TRAC:CLEAR':
+            self.buffer = np.zeros((0, 4))
+            self.buffer_ready_time = None
+        elif header == 'INIT':
+            n_readings = self.arm_count * self.trigger_count
+            self.buffer = self.measure(n_readings)[:self.buffer_points]
+            self.buffer_ready_time = time.monotonic() + self.integration_time(n_readings)
+        elif header == 'TRAC:DATA?':
+            columns = [i for i, element in enumerate(['VOLT', 'CURR', 'RES', 'TIME']) if element in self.elements]
+            return ','.join('%e' % value for value in self.buffer[:, columns].ravel())
+        elif header == 'CALC3:FORM':
+            self.calc_form = argument
+        elif header == 'CALC3:DATA?':
+            readings = self.buffer[:, :3]
+            if self.calc_form == 'SDEV':
+                values = readings.std(axis=0, ddof=1 if len(readings) > 1 else 0)
+            else:
+                values = readings.mean(axis=0)
+            return ','.join('%e' % value for value in values)
+        elif header == 'ABOR':
+            self.buffer_ready_time = None
+        elif header in ('STATUS:QUEUE:CLEAR', 'STAT:PRES', '*CLS', '*SRE', 'STAT:MEAS:ENAB', 'ROUT:TERM',
+                        'SENS:FUNC', 'SENS:CURR:RANG:AUTO', 'SOUR:VOLT:PROT', 'SYST:RSEN', 'TRAC:FEED',
+                        'TRAC:FEED:CONT', 'SOUR:FUNC', 'SOUR:SWE:SPAC', 'SOUR:SWE:RANG', 'FORM:DATA',
+                        'SENS:AVER:TCON'):
+            pass  # accepted without effect on the simulation
+        else:
+            self.errors.append('-113,"Undefined header"')
+        return None
+
+
+def benchmark(n_data_points=142, averages=5, delay=0.025, latency=0.005, current_noise=1e-5, hardware_sweep=False):
+    """ Runs one sweep against the simulated instrument and reports sweep time and per-point overhead. """
+    from hardware.engine import get_engine
+    from hardware.keithley import Keithley
+
+    keithley = Keithley(gpib_port=SIM_PORT, n_data_points=n_data_points, averages=averages, delay=delay,
+                        sim_settings={'latency': latency, 'current_noise': current_noise},
+                        hardware_sweep=hardware_sweep, engine=get_engine())
+    keithley.config_keithley()
+    adapter = keithley.sourcemeter.adapter
+    transactions = adapter.transactions
+    t_start = time.monotonic()
+    keithley.engine.submit(keithley.measure_curve()).wait()
+    sweep_time = time.monotonic() - t_start
+    transactions = adapter.transactions - transactions
+    integration = n_data_points * averages * adapter.nplc / 50.
+    settling = n_data_points * delay
+    data = keithley.get_keithley_data()
+    phases = keithley.get_phase_timing().mean()
+    return {'sweep time (s)': sweep_time,
+            'time per point (ms)': 1e3 * sweep_time / n_data_points,
+            'overhead per point (ms)': 1e3 * (sweep_time - integration - settling) / n_data_points,
+            'bus transactions per point': transactions / n_data_points,
+            'open circuit voltage (V)': data.loc[data['Current (A)'].abs().idxmin(), 'Voltage (V)'],
+            'short circuit current (A)': data.loc[data['Voltage (V)'].abs().idxmin(), 'Current (A)'],
+            **{'%s per point (ms)' % phase[:-4]: 1e3 * duration for phase, duration in phases.items()}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark IV sweeps against a simulated Keithley 2400.')
+    parser.add_argument('--points', type=int, default=142)
+    parser.add_argument('--averages', type=int, default=5)
+    parser.add_argument('--delay', type=float, default=0.025, help='settling delay per point (s)')
+    parser.add_argument('--latency', type=float, default=0.005, help='time per bus transaction (s)')
+    parser.add_argument('--noise', type=float, default=1e-5, help='current noise (A)')
+    parser.add_argument('--hardware-sweep', action='store_true', help='let the instrument run the sweep')
+    args = parser.parse_args()
+    results = benchmark(args.points, args.averages, args.delay, args.latency, args.noise, args.hardware_sweep)
+    for key, value in results.items():
+        print('%s: %.4g' % (key, value))
@@ -0,0 +1,207 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+import os
+from PyQt5 import QtCore
+import tempfile
+import time
+
+from hardware.engine import get_engine
+from hardware.keithley import Keithley
+from hardware.keithley_sim import SIM_PORT
+from hardware.sensor import ArduinoSensor
+from utility.save_info import save_info, save_settings
+
+
+class Rig(QtCore.QObject):
+    """
+    One measurement setup, a source meter paired with a sensor board, saving into its own folder.
+
+    run() measures a number of experiments of keithley_settings['repetitions'] curves each, like the experiment loop
+    of the Experiment tab, over one persistent sensor link. Sensor and scans run as tasks of engine, the shared
+    AcquisitionEngine by default. Keithley signals are connected directly, so a rig needs no Qt event loop and
+    several rigs can run side by side in a RigScheduler.
+    """
+    to_log = QtCore.pyqtSignal(str)
+    update = QtCore.pyqtSignal(str, int)  # rig name, data point
+    finished = QtCore.pyqtSignal(str)
+
+    def __init__(self, name, directory, keithley_settings=None, sensor_settings=None, experiments=1,
+                 experiment_delay=30.0, info=None, engine=None):
+        super(Rig, self).__init__()
+        self.name = name
+        self.directory = directory
+        self.keithley_settings = keithley_settings or {}  # keyword arguments of Keithley
+        self.sensor_settings = sensor_settings or {}  # keyword arguments of ArduinoSensor
+        self.experiments = experiments
+        self.experiment_delay = experiment_delay  # seconds between experiments
+        self.info = info or {}  # keyword arguments of save_info
+        self.engine = engine
+        self.experiment_directory = directory
+        self.keithley = None
+        self.sensor = None
+        self.is_run = False
+        self.curves_saved = 0
+        self.error = None
+
+    def run(self):
+        """ Measures all experiments, blocks until done or aborted. """
+        self.is_run = True
+        self.curves_saved = 0
+        self.error = None
+        engine = self.engine or get_engine()
+        self.sensor = ArduinoSensor(engine=engine, **self.sensor_settings)
+        self.sensor.to_log.connect(self.log, QtCore.Qt.DirectConnection)
+        self.sensor.start()
+        try:
+            for experiment in range(self.experiments):
+                if not self.is_run:
+                    break
+                self.experiment_directory = self.directory if self.experiments == 1 else \
+                    '%s %d' % (self.directory, experiment)
+                os.makedirs(self.experiment_directory, exist_ok=True)
+                reference = self.keithley.reference if self.keithley is not None else None
+                self.keithley = Keithley(experiment_delay=0. if experiment == 0 else self.experiment_delay,
+                                         sensor=self.sensor, reference=reference, engine=engine,
+                                         **self.keithley_settings)
+                self.keithley.trace_directory = self.experiment_directory
+                self.keithley.to_log.connect(self.log, QtCore.Qt.DirectConnection)
+                self.keithley.update.connect(self.point_done, QtCore.Qt.DirectConnection)
+                self.keithley.save_settings.connect(self.save_configuration, QtCore.Qt.DirectConnection)
+                self.keithley.save.connect(self.save_curve, QtCore.Qt.DirectConnection)
+                if not self.is_run:
+                    break
+                try:
+                    self.keithley.read_keithley_start()
+                    if not self.is_run:  # aborted before the task existed
+                        self.keithley.task.cancel()
+                    while not self.keithley.task.wait(0.5):  # an endless wait ignores Ctrl+C on Windows
+                        pass
+                    if self.keithley.task.error is not None:
+                        raise self.keithley.task.error
+                finally:
+                    self.keithley.close()
+        except Exception as error:
+            self.error = error
+            self.log('<span style=\" color:#ff0000;\" >Rig stopped: %s</span>' % str(error))
+        finally:
+            self.sensor.stop()
+            self.is_run = False
+            self.finished.emit(self.name)
+
+    def abort(self):
+        """ Cancels the running scan at its next await, without waiting for it. """
+        self.is_run = False
+        keithley = self.keithley
+        if keithley is not None and keithley.task is not None:
+            keithley.task.cancel()
+
+    def log(self, string):
+        self.to_log.emit('%s: %s' % (self.name, string))
+
+    def point_done(self, datapoint):
+        self.update.emit(self.name, datapoint)
+
+    def save_configuration(self):
+        keithley, sensor = self.keithley, self.sensor
+        save_settings(os.path.join(self.experiment_directory, 'Settings.txt'),
+                      keithley_port=keithley.gpib_port, start_voltage=keithley.min_voltage,
+                      end_voltage=keithley.max_voltage,
+                      voltage_step="%.3f" % ((keithley.max_voltage - keithley.min_voltage) / keithley.planned_points),
+                      n_steps=keithley.planned_points, current_limit=keithley.compliance_current,
+                      averages=keithley.averages, delay=keithley.delay, hardware_sweep=keithley.hardware_sweep,
+                      adaptive=keithley.adaptive, binary_traces=keithley.binary_traces, traces=keithley.repetitions,
+                      trace_delay=keithley.repetition_delay,
+                      sensor_port=sensor.port, baud_rate=sensor.baud_rate, data_bytes=sensor.data_num_bytes,
+                      datapoints=sensor.n_data_points, analogue_inputs=sensor.n_ai,
+                      query_period=sensor.query_period, timeout=sensor.timeout)
+
+    def save_curve(self, repetition):  # the Keithley has written IV_Curve_<repetition>.csv already
+        save_info(file_path=os.path.join(self.experiment_directory, 'IV_Curve_%s.dat' % str(repetition)),
+                  **dict({'folder': [self.experiment_directory]}, **self.info))
+        self.curves_saved += 1
+
+
+class RigScheduler:
+    """
+    Runs several rigs concurrently on a shared pool of worker threads, at most max_rigs at a time.
+
+    Every rig can be stopped on its own, further rigs wait in the pool until a running one finishes.
+    """
+    def __init__(self, rigs=None, max_rigs=None):
+        self.max_rigs = max_rigs
+        self.rigs = {}
+        self.futures = {}
+        self.executor = None
+        for rig in rigs or []:
+            self.add(rig)
+
+    def add(self, rig):
+        if rig.name in self.rigs:
+            raise ValueError('A rig named %s already exists.' % rig.name)
+        self.rigs[rig.name] = rig
+
+    def start(self, names=None):
+        """ Starts the given rigs, all rigs that are not running by default. """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_rigs or max(1, len(self.rigs)),
+                                               thread_name_prefix='rig')
+        for name in names or list(self.rigs):
+            if name not in self.futures or self.futures[name].done():
+                self.futures[name] = self.executor.submit(self.rigs[name].run)
+
+    def running(self):
+        return [name for name, future in self.futures.items() if not future.done()]
+
+    def stop(self, name):
+        self.rigs[name].abort()
+
+    def abort(self):
+        for rig in self.rigs.values():
+            rig.abort()
+
+    def wait(self, timeout=None):
+        """ Blocks until all started rigs are done, returns False if timeout passed first. """
+        _, not_done = concurrent.futures.wait(list(self.futures.values()), timeout=timeout)
+        return not not_done
+
+    def shutdown(self):
+        self.abort()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+def benchmark(n_rigs=3, n_data_points=40, repetitions=2, latency=0.005, directory=None):
+    """ Runs n_rigs simulated rigs with synthetic sensors concurrently and reports the aggregate throughput. """
+    directory = directory or tempfile.mkdtemp(prefix='rigs ')
+    scheduler = RigScheduler([Rig('rig %d' % i, os.path.join(directory, 'rig %d' % i),
+                                  keithley_settings={'gpib_port': SIM_PORT, 'n_data_points': n_data_points,
+                                                     'repetitions': repetitions, 'repetition_delay': 0.,
+                                                     'delay': 0.025, 'sim_settings': {'latency': latency}},
+                                  sensor_settings={'port': 'dummy'})
+                              for i in range(n_rigs)])
+    t_start = time.monotonic()
+    scheduler.start()
+    scheduler.wait()
+    elapsed = time.monotonic() - t_start
+    scheduler.shutdown()
+    curves = sum(rig.curves_saved for rig in scheduler.rigs.values())
+    return {'rigs': n_rigs,
+            'curves': curves,
+            'elapsed (s)': elapsed,
+            'curves per minute': 60. * curves / elapsed,
+            'points per second': curves * n_data_points / elapsed}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run several simulated rigs concurrently.')
+    parser.add_argument('--rigs', type=int, default=3)
+    parser.add_argument('--points', type=int, default=40)
+    parser.add_argument('--repetitions', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.005, help='time per bus transaction (s)')
+    parser.add_argument('--directory', default=None, help='output folder, a temporary folder by default')
+    args = parser.parse_args()
+    results = benchmark(args.rigs, args.points, args.repetitions, args.latency, args.directory)
+    for key, value in results.items():
+        print('%s: %.4g' % (key, value))
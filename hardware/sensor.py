@@ -1,9 +1,14 @@
+import asyncio
+import numpy as np
 from PyQt5 import QtCore
 import pyqtgraph as pg
 import threading
 import time
 
 from hardware.arduino_ai import SerialRead
+from hardware.engine import get_engine, periodic
+from utility import decimate
+from utility.sensor_log import SensorLog
 
 
 class ArduinoSensor(QtCore.QObject):
@@ -11,49 +16,105 @@ class ArduinoSensor(QtCore.QObject):
     to_log = QtCore.pyqtSignal(str)
 
     def __init__(self, port='COM3', baud=38400, n_data_points=100, data_num_bytes=2, n_ai=5, timeout=30.0,
-                 query_period=0.25):
+                 query_period=0.25, n_frames=100000, dummy_rate=200.0, engine=None, sample_period=None):
         super(ArduinoSensor, self).__init__()
         self.port = port
         self.baud_rate = baud
         self.query_period = query_period
+        self.sample_period = sample_period or query_period  # seconds between samples of the plotted history
         self.n_data_points = n_data_points
         self.data_num_bytes = data_num_bytes
         self.n_ai = n_ai  # number of analogue inputs
+        self.n_frames = n_frames  # number of raw frames kept in the stream history
+        self.dummy_rate = dummy_rate  # frames per second of the synthetic source on the 'dummy' port
         self.timeout = timeout
+        self.engine = engine  # AcquisitionEngine that runs the acquisition, the shared one of get_engine by default
+        self.task = None
         self.abort = threading.Event()
         self.abort.clear()
         self.ser = None
-        self.mes_thread = None
+        self.log = None
 
     def start(self):
-        if self.mes_thread is None:
-            self.mes_thread = threading.Thread(target=self.run)
-            self.mes_thread.start()
-        else:
-            print('Warning: self.thread already existing.')
+        if self.task is not None:
+            print('Warning: measurement already running.')
+            return
+        if self.engine is None:
+            self.engine = get_engine()
+        # created before the task, so that start_log always finds the link it has to attach the log to
+        self.ser = SerialRead(self.port, self.baud_rate, self.n_data_points, self.data_num_bytes, self.n_ai,
+                              self.n_frames, self.dummy_rate, sample_period=self.sample_period)
+        self.ser.log = self.log
+        self.ser.to_log.connect(self.log_pipeline, QtCore.Qt.DirectConnection)  # works without an event loop
+        self.task = self.engine.submit(self.run_task())
 
     def stop(self):
-        if self.mes_thread is not None:
+        if self.task is not None:
             self.abort.set()
-            self.mes_thread.join(self.timeout)
-            if not self.mes_thread.is_alive():
-                del self.mes_thread
-            else:
+            self.task.cancel()
+            if not self.task.wait(self.timeout):
                 print('Warning: failed to stop measurement.')
+        self.stop_log()
+
+    async def run_task(self):
+        """ Acquisition as an engine task, reading the port and emitting update on one fixed-rate clock. """
+        await self.engine.run_blocking(self.ser.connect)
+        reader = asyncio.ensure_future(self.ser.background_task(self.engine))
+        try:
+            async for _ in self.samples():
+                self.update.emit()
+        finally:
+            reader.cancel()
+            await asyncio.gather(reader, return_exceptions=True)
+            self.ser.close()
 
-    def run(self):
+    async def samples(self, period=None):
+        """ Stream of [time, channel 0, ..., channel n_ai - 1] snapshots, one every period (query_period) seconds. """
+        async for _ in periodic(period or self.query_period):
+            yield self.ser.snapshot()
+
+    def wait_ready(self, timeout=5.0):
         """
-        run - main loop for sensor acquisition. This function is started in a thread by start()
-        do not call directly, since it will then block the main loop
+        Readiness handshake, blocks until frames arrive from the board.
+
+        Returns False after timeout, once the sensor is stopped and as soon as an attempt to (re)open the port
+        fails, so that callers do not wait longer than needed for a link that is down.
         """
-        self.ser = SerialRead(self.port, self.baud_rate, self.n_data_points, self.data_num_bytes, self.n_ai)
-        self.ser.to_log.connect(self.log_pipeline)
-        self.ser.connect()
-        self.ser.read_serial_start()
-        while not self.abort.isSet():
-            time.sleep(self.query_period)
-            self.update.emit()
-        self.ser.close()
+        deadline = time.monotonic() + timeout
+        failed_connects = None
+        while not self.abort.is_set() and time.monotonic() < deadline:
+            ser = self.ser
+            if ser is None:
+                time.sleep(0.01)
+                continue
+            if failed_connects is None:
+                failed_connects = ser.failed_connects
+            if ser.connected.wait(0.01):
+                return True
+            if ser.failed_connects > failed_connects:
+                return False
+        return False
+
+    def start_log(self, directory, block_period=1.0):
+        """ Streams every frame received from now on to a SensorLog in the new folder directory. """
+        self.stop_log()
+        ser = self.ser
+        init_time = time.monotonic() if ser is None else ser.init_time
+        self.log = SensorLog(directory, ['Time (s)', 'Temperature (C)'] +
+                             ['Irradiance %d (W/m2)' % i for i in range(1, self.n_ai)], block_period=block_period,
+                             time_origin=time.time() - (time.monotonic() - init_time))
+        if ser is not None:
+            ser.log = self.log
+        self.to_log.emit('<span style=\" color:#000000;\" >Logging sensor data to ' + directory + '.</span>')
+        return self.log
+
+    def stop_log(self):
+        if self.log is None:
+            return
+        if self.ser is not None:
+            self.ser.log = None
+        self.log.close()
+        self.log = None
 
     @QtCore.pyqtSlot(str)
     def log_pipeline(self, string):
@@ -67,7 +128,6 @@ class ArduinoSensor(QtCore.QObject):
             xval, yval = [], []
         elif channel == 'temp':
             xval, yval, _ = self.ser.get_serial_data(0)
-            yval = yval * 100
         elif channel == 'power1':
             xval, yval, _ = self.ser.get_serial_data(1)
         elif channel == 'power2':
@@ -78,13 +138,48 @@ class ArduinoSensor(QtCore.QObject):
             xval, yval, _ = self.ser.get_serial_data(4)
         else:
             xval, yval = [], []
-        target_line.setData(xval, yval)
+        decimate.set_data(target_line, xval, yval)
+
+    def get_sensor_window(self, start, end):
+        """
+        Channel means over the frames received between the monotonic times start and end.
+
+        A window too short to contain a frame gets the readings interpolated at its centre, and without any
+        received frames the latest readings are returned. Synthetic frames of the 'dummy' port are only plotted,
+        points are tagged with -1 (missing) then.
+        """
+        ser = self.ser
+        if ser is None or ser.synthetic or len(ser.frames) == 0:
+            return self.get_sensor_latest()[1]
+        _, values = ser.get_frames(start - ser.init_time, end - ser.init_time)
+        if values.shape[1] > 0:
+            return list(values.mean(axis=1))
+        return list(self.get_sensor_at([(start + end) / 2.])[:, 0])
+
+    def get_sensor_at(self, times):
+        """ Channel readings interpolated at the given monotonic times, with the shape (n_ai, n_times). """
+        times = np.asarray(times, dtype=np.float64)
+        ser = self.ser
+        if ser is None or ser.synthetic or len(ser.frames) == 0:
+            return np.repeat(np.array(self.get_sensor_latest()[1])[:, np.newaxis], times.size, axis=1)
+        frame_times, frame_values = ser.get_frames()
+        return np.vstack([np.interp(times - ser.init_time, frame_times, channel) for channel in frame_values])
+
+    def get_sensor_samples(self, count=0):
+        """ Times, values (n_ai, n) and total count of the history samples recorded after the first count ones. """
+        if self.ser is None:
+            return np.zeros(0), np.zeros((self.n_ai, 0)), 0
+        return self.ser.get_samples(count)
 
     def get_sensor_latest(self):
-        if not self.port == 'dummy':
-            sensor_time = self.ser.get_serial_data(0)[0][-1]
-            sensor_readout = [self.ser.get_serial_data(i)[2] for i in range(self.n_ai)]
-        else:
-            sensor_time = 0.
-            sensor_readout = [-1.0 for _ in range(self.n_ai)]
-        return sensor_time, sensor_readout
+        """
+        Time and channel values of the latest frame. The values are -1 (missing) for the 'dummy' port and as long as
+        no frame has been received.
+        """
+        ser = self.ser
+        if ser is None:
+            return 0., [-1.0 for _ in range(self.n_ai)]
+        snapshot = ser.snapshot()  # all channels from the same frame
+        if ser.synthetic or ser.frames_received == 0:  # synthetic or initial values must not end up in saved curves
+            return snapshot[0], [-1.0 for _ in range(self.n_ai)]
+        return snapshot[0], list(snapshot[1:])
@@ -0,0 +1,147 @@
+import argparse
+from configparser import ConfigParser
+import os
+from PyQt5 import QtCore
+import re
+import signal
+import sys
+import time
+
+from hardware.rig import Rig, RigScheduler
+from utility.config import defaults, ports
+from utility.save_info import info_pars
+
+TEMPLATE = """[experiment]
+directory = %(directory)s
+experiments = %(experiments)s
+# minutes between experiments, as in the Experiment tab
+experiment_delay = %(experiment_delay)s
+
+[iv]
+port = %(keithley)s
+start_voltage = %(start_voltage)s
+end_voltage = %(end_voltage)s
+n_steps = %(n_steps)s
+current_limit = %(current_limit)s
+averages = %(averages)s
+delay = %(delay)s
+traces = %(traces)s
+trace_delay = %(trace_delay)s
+hardware_sweep = no
+adaptive = no
+binary_traces = no
+
+[sensor]
+port = %(arduino)s
+baud_rate = 38400
+data_bytes = 2
+datapoints = 100
+analogue_inputs = 5
+query_period = 0.25
+timeout = 30.0
+
+[info]
+experiment_name = N/A
+film_id = unknown
+pv_cell_id = unknown
+"""
+
+
+def template():
+    """ Example configuration with the defaults of the Experiment tab. """
+    iv = defaults['iv']
+    return TEMPLATE % {'directory': os.path.join(os.getcwd(), 'experiment'), 'experiments': iv[9],
+                       'experiment_delay': iv[10], 'keithley': ports['keithley'], 'start_voltage': iv[0],
+                       'end_voltage': iv[1], 'n_steps': iv[3], 'current_limit': iv[4], 'averages': iv[5],
+                       'delay': iv[6], 'traces': iv[7], 'trace_delay': iv[8], 'arduino': ports['arduino']}
+
+
+def read_settings(file_path):
+    """ Parses a configuration file into the keyword arguments of Rig, applying the bounds of the Experiment tab. """
+    config = ConfigParser(inline_comment_prefixes=('#', ';'))
+    config.read_string(template())
+    if not config.read(file_path):
+        raise ValueError('Cannot read %s.' % file_path)
+    experiment, iv, sensor = config['experiment'], config['iv'], config['sensor']
+    if any([iv.getfloat('end_voltage') > 0.75,
+            iv.getfloat('start_voltage') < -0.15,
+            iv.getfloat('start_voltage') > iv.getfloat('end_voltage'),
+            iv.getfloat('delay') < 0.01,
+            iv.getfloat('trace_delay') < 0.5,
+            experiment.getfloat('experiment_delay') < 0.5,
+            iv.getfloat('current_limit') > 0.5,
+            iv.getfloat('current_limit') <= 0.,
+            iv.getint('averages') < 1,
+            iv.getint('traces') < 1,
+            experiment.getint('experiments') < 1]):
+        raise ValueError('Some parameters are out of bounds.')
+    return {'name': os.path.basename(os.path.normpath(experiment['directory'])),
+            'directory': experiment['directory'],
+            'experiments': experiment.getint('experiments'),
+            'experiment_delay': 60. * experiment.getfloat('experiment_delay'),
+            'keithley_settings': {'gpib_port': iv['port'], 'n_data_points': iv.getint('n_steps'),
+                                  'averages': iv.getint('averages'), 'repetitions': iv.getint('traces'),
+                                  'repetition_delay': iv.getfloat('trace_delay'), 'delay': iv.getfloat('delay'),
+                                  'min_voltage': iv.getfloat('start_voltage'),
+                                  'max_voltage': iv.getfloat('end_voltage'),
+                                  'compliance_current': iv.getfloat('current_limit'),
+                                  'hardware_sweep': iv.getboolean('hardware_sweep'),
+                                  'adaptive': iv.getboolean('adaptive'),
+                                  'binary_traces': iv.getboolean('binary_traces')},
+            'sensor_settings': {'port': sensor['port'], 'baud': sensor.getint('baud_rate'),
+                                'n_data_points': sensor.getint('datapoints'),
+                                'data_num_bytes': sensor.getint('data_bytes'),
+                                'n_ai': sensor.getint('analogue_inputs'), 'timeout': sensor.getfloat('timeout'),
+                                'query_period': sensor.getfloat('query_period')},
+            'info': {key: [value] for key, value in config['info'].items() if key in info_pars}}
+
+
+def print_log(string):
+    """ Prints a log message of the instruments without its HTML markup. """
+    print('[%s] %s' % (time.strftime('%H:%M:%S'), re.sub('<[^>]*>', '', string)), flush=True)
+
+
+def run(file_paths):
+    """
+    Measures the experiments of one or more configuration files, one rig per file running side by side in a
+    RigScheduler. Returns the number of saved curves.
+    """
+    scheduler = RigScheduler()
+    for file_path in file_paths:
+        rig = Rig(**read_settings(file_path))
+        first_directory = rig.directory if rig.experiments == 1 else '%s 0' % rig.directory  # as named by Rig
+        if os.path.exists(os.path.join(first_directory, 'Settings.txt')) or \
+                os.path.exists(os.path.join(first_directory, 'IV_Curve_0.csv')):
+            raise ValueError('%s contains a measurement already.' % first_directory)
+        if rig.name in scheduler.rigs:  # folders of the same name in different places
+            rig.name = rig.directory
+        rig.to_log.connect(print_log, QtCore.Qt.DirectConnection)
+        scheduler.add(rig)
+
+    def abort(*_):
+        print_log('Aborting the scans.')
+        scheduler.abort()
+
+    signal.signal(signal.SIGINT, abort)
+    signal.signal(signal.SIGTERM, abort)
+    scheduler.start()
+    while not scheduler.wait(0.5):  # an endless wait ignores Ctrl+C on Windows
+        pass
+    scheduler.shutdown()
+    for rig in scheduler.rigs.values():
+        if rig.error is not None:
+            raise rig.error
+    return sum(rig.curves_saved for rig in scheduler.rigs.values())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure IV curves without the GUI. The configuration file lists '
+                                                 'the experiment, IV, sensor and info parameters of the '
+                                                 'Experiment tab. Several files run several rigs side by side.')
+    parser.add_argument('config', nargs='*', help='configuration files (INI format), one per rig')
+    parser.add_argument('--template', action='store_true', help='print an example configuration and exit')
+    args = parser.parse_args()
+    if args.template or not args.config:
+        print(template(), end='')
+        sys.exit(0)
+    print_log('Saved %d curves.' % run(args.config))
@@ -64,12 +64,13 @@ void sendToPC(int16_t* data0, int16_t* data1, int16_t* data2, int16_t* data3, in
   byte* byteData2 = (byte*)(data2);
   byte* byteData3 = (byte*)(data3);
   byte* byteData4 = (byte*)(data4);
-  byte buf[10] = {byteData0[0], byteData0[1],
+  byte buf[12] = {0xAA, 0x55,  // frame sync marker
+                  byteData0[0], byteData0[1],
                   byteData1[0], byteData1[1],
                   byteData2[0], byteData2[1],
                   byteData3[0], byteData3[1],
                   byteData4[0], byteData4[1]};
-  Serial.write(buf, 10);
+  Serial.write(buf, 12);
 }
  
 //void sendToPC(double* data0, double* data1, double* data2, double* data3, double* data4)
@@ -79,12 +80,13 @@ void sendToPC(int16_t* data0, int16_t* data1, int16_t* data2, int16_t* data3, in
 //  byte* byteData2 = (byte*)(data2);
 //  byte* byteData3 = (byte*)(data3);
 //  byte* byteData4 = (byte*)(data4);
-//  byte buf[20] = {byteData0[0], byteData0[1], byteData0[2], byteData0[3],
+//  byte buf[22] = {0xAA, 0x55,
+//                  byteData0[0], byteData0[1], byteData0[2], byteData0[3],
 //                  byteData1[0], byteData1[1], byteData1[2], byteData1[3],
 //                  byteData2[0], byteData2[1], byteData2[2], byteData2[3],
 //                  byteData3[0], byteData3[1], byteData3[2], byteData3[3],
 //                  byteData4[0], byteData4[1], byteData4[2], byteData4[3]};
-//  Serial.write(buf, 20);
+//  Serial.write(buf, 22);
 //}
 
 
@@ -0,0 +1,19 @@
+import os
+import time
+
+from hardware.sensor import ArduinoSensor
+from utility.sensor_log import SensorLogReader
+
+
+def test_log_started_with_acquisition(tmp_path):
+    """ A log started right after start(), while the acquisition task is still starting up, gets every frame. """
+    for attempt in range(5):
+        sensor = ArduinoSensor(port='dummy', query_period=0.05)
+        sensor.start()
+        directory = os.path.join(str(tmp_path), 'Sensor Log %d' % attempt)
+        sensor.start_log(directory, block_period=0.1)
+        time.sleep(0.5)
+        sensor.stop()
+        times, values = SensorLogReader(directory).read_window()
+        assert times.size > 0
+        assert values.shape == (sensor.n_ai, times.size)
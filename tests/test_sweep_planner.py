@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from utility import sweep_planner
+from utility.trace_files import SKIPPED_POINTS
+
+MIN_VOLTAGE, MAX_VOLTAGE = -0.01, 0.7  # defaults of Keithley
+
+
+def diode_current(voltage, iph=0.05, i0=1e-9, ideality=1.5, rsh=1000.):
+    """ Single diode model of SimulatedKeithley2400. """
+    return iph - i0 * (np.exp(voltage / (ideality * 0.025693)) - 1) - voltage / rsh
+
+
+def isc_estimates(voltages):
+    """ I_sc as Trace.get_isc and Trace.fit_isc find it on a curve measured at voltages. """
+    voltages = voltages[SKIPPED_POINTS:]
+    currents = diode_current(voltages)
+    isc_index = np.argmin(np.abs(voltages))
+    fit_range = slice(0, isc_index + sweep_planner.ISC_FIT_POINTS)
+    return currents[isc_index], np.polyfit(voltages[fit_range], currents[fit_range], 1)[1]
+
+
+@pytest.mark.parametrize('n_data_points', [142, 60, 40, 30])
+def test_planned_isc_as_good_as_uniform(n_data_points):
+    reference = sweep_planner.coarse_voltages(MIN_VOLTAGE, MAX_VOLTAGE, n_data_points)
+    planned = sweep_planner.plan_voltages(reference, diode_current(reference), n_data_points, MIN_VOLTAGE,
+                                          MAX_VOLTAGE)
+    uniform = np.linspace(MIN_VOLTAGE, MAX_VOLTAGE, n_data_points)
+    isc = diode_current(0.)
+    planned_errors = np.abs(np.array(isc_estimates(planned)) - isc)
+    uniform_errors = np.abs(np.array(isc_estimates(uniform)) - isc)
+    assert planned.size == n_data_points
+    assert np.all(np.diff(planned) > 0)
+    assert np.all(planned_errors <= uniform_errors + 1e-9)
+
+
+def test_planned_points_dense_around_zero():
+    reference = sweep_planner.coarse_voltages(MIN_VOLTAGE, MAX_VOLTAGE, 30)
+    planned = sweep_planner.plan_voltages(reference, diode_current(reference), 30, MIN_VOLTAGE, MAX_VOLTAGE)
+    analysed = planned[SKIPPED_POINTS:]
+    assert np.sum(np.abs(analysed) <= 0.01) >= SKIPPED_POINTS + sweep_planner.ISC_FIT_POINTS
@@ -5,14 +5,16 @@ from PyQt5 import QtWidgets, QtGui, QtCore
 from PyQt5.Qt import Qt
 
 import utility.colors as colors
+import utility.decimate as decimate
 import utility.plots as plots
 from utility.conversions import timestamp_to_datetime_hour, metric_prefix
-from utility.data_import import Experiment, Group
+from utility.data_import import Group, load_bundles
 from utility.widgets import TreeWidgetItem, ItemSignal
 from user_interfaces.multi_dir_dialog import MultiDirDialog
 from utility.config import paths
 from utility.excel_export import save_to_xlsx
 from utility.folders import get_experiment_folders, get_group_file_paths
+from utility.sensor_log import SensorLogReader, STREAMS
 
 
 line_plot_dict = {'Time': 'Time (s)',
@@ -71,6 +73,7 @@ class Analysis(QtWidgets.QWidget):
 
         self.analysis_directory = paths['last_analysis']
         self.export_directory = paths['last_export']
+        self.sensor_log = None  # SensorLogReader of the opened Sensor Log folder
 
         hbox_total = QtWidgets.QHBoxLayout()
         vbox_left = QtWidgets.QVBoxLayout()
@@ -408,6 +411,40 @@ class Analysis(QtWidgets.QWidget):
         self.export_group_box.setLayout(hbox_data_export)
         vbox_right.addWidget(self.export_group_box)
 
+        self.sensor_log_group_box = QtWidgets.QGroupBox('Sensor Log')
+        hbox_sensor_log = QtWidgets.QHBoxLayout()
+        self.sensor_log_button = QtWidgets.QPushButton(
+            QtGui.QIcon(os.path.join(paths['icons'], 'folder.png')), '')
+        self.sensor_log_button.clicked.connect(self.open_sensor_log)
+        self.sensor_log_button.setToolTip('Open Sensor Log folder')
+        hbox_sensor_log.addWidget(self.sensor_log_button)
+        self.sensor_log_edit = QtWidgets.QLineEdit('', self)
+        self.sensor_log_edit.setMinimumWidth(120)
+        self.sensor_log_edit.setDisabled(True)
+        hbox_sensor_log.addWidget(self.sensor_log_edit)
+        self.sensor_log_start_label = QtWidgets.QLabel("From (min)", self)
+        hbox_sensor_log.addWidget(self.sensor_log_start_label)
+        self.sensor_log_start_edit = QtWidgets.QLineEdit('0', self)
+        self.sensor_log_start_edit.setFixedWidth(50)
+        hbox_sensor_log.addWidget(self.sensor_log_start_edit)
+        self.sensor_log_end_label = QtWidgets.QLabel("To (min)", self)
+        hbox_sensor_log.addWidget(self.sensor_log_end_label)
+        self.sensor_log_end_edit = QtWidgets.QLineEdit('', self)
+        self.sensor_log_end_edit.setFixedWidth(50)
+        self.sensor_log_end_edit.setToolTip('Leave empty to plot up to the end of the log')
+        hbox_sensor_log.addWidget(self.sensor_log_end_edit)
+        self.sensor_log_stream_cb = QtWidgets.QComboBox()
+        self.sensor_log_stream_cb.addItems(reversed(STREAMS))
+        self.sensor_log_stream_cb.setToolTip('Frames averaged over the log block period, or every raw frame')
+        hbox_sensor_log.addWidget(self.sensor_log_stream_cb)
+        self.sensor_log_plot_button = QtWidgets.QPushButton(
+            QtGui.QIcon(os.path.join(paths['icons'], 'refresh.png')), '')
+        self.sensor_log_plot_button.clicked.connect(self.plot_sensor_log)
+        self.sensor_log_plot_button.setToolTip('Plot sensor log')
+        hbox_sensor_log.addWidget(self.sensor_log_plot_button)
+        self.sensor_log_group_box.setLayout(hbox_sensor_log)
+        vbox_right.addWidget(self.sensor_log_group_box)
+
         self.analysis_group_box = QtWidgets.QGroupBox('Experiment data')
         vbox_analysis = QtWidgets.QVBoxLayout()
         hbox_analysis = QtWidgets.QHBoxLayout()
@@ -585,11 +622,12 @@ class Analysis(QtWidgets.QWidget):
             tree_item.signal.itemChecked.connect(self.tree_checkbox_changed)
 
     def update_experiment_data(self):
-        for path in self.experiment_paths:
-            if path not in self.experiment_dict.keys() and path.endswith('.gpkl'):
-                self.experiment_dict[path] = Group(path)
-            elif path not in self.experiment_dict.keys():
-                self.experiment_dict[path] = Experiment(path)
+        new_paths = [path for path in self.experiment_paths if path not in self.experiment_dict.keys()]
+        QtWidgets.QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            self.experiment_dict.update(load_bundles(new_paths))  # loaded in parallel worker processes
+        finally:
+            QtWidgets.QApplication.restoreOverrideCursor()
         for path in list(self.experiment_dict.keys()):
             if path not in self.experiment_paths:
                 self.experiment_dict[path].save_pickle()  # save analysed data in pickle
@@ -1130,6 +1168,55 @@ class Analysis(QtWidgets.QWidget):
             axis2.set_ylabel(" /\n".join([item[0] for item in self.plot_y if item[1] == 'y2']))
         self.update_plt.emit()
 
+    def open_sensor_log(self):
+        directory = str(QtWidgets.QFileDialog.getExistingDirectory(self, 'Select Sensor Log',
+                                                                   self.analysis_directory))
+        if directory == '':
+            return
+        try:
+            self.sensor_log = SensorLogReader(directory)
+        except ValueError:
+            self.sensor_log = None
+            self.sensor_log_edit.setText('Not a sensor log: ' + os.path.basename(directory))
+            return
+        self.sensor_log_edit.setText(os.path.basename(directory))
+        self.plot_sensor_log()
+
+    def plot_sensor_log(self):
+        """
+        Plots temperature (y1) and irradiances (y2) of the sensor log between From and To, counted from the first
+        frame of the log. Only the window is read from disk and long windows are decimated to the canvas width.
+        """
+        if self.sensor_log is None:
+            return
+        stream = self.sensor_log_stream_cb.currentText()
+        time_range = self.sensor_log.time_range(stream)
+        if time_range is None:
+            return
+        try:
+            start = time_range[0] + 60. * float(self.sensor_log_start_edit.text())
+            end = time_range[0] + 60. * float(self.sensor_log_end_edit.text()) \
+                if self.sensor_log_end_edit.text().strip() else None
+        except ValueError:
+            return
+        times, values = self.sensor_log.read_window(start, end, stream)
+        minutes = (times - time_range[0]) / 60.
+        self.plot_canvas.figure.clear()
+        axis = self.plot_canvas.figure.add_subplot(111)
+        axis2 = axis.twinx()
+        axis2.yaxis.tick_right()
+        axis2.yaxis.set_label_position("right")
+        axis.set_title(os.path.basename(self.sensor_log.directory))
+        for channel, (column, channel_values) in enumerate(zip(self.sensor_log.columns[1:], values)):
+            x, y = decimate.decimate(minutes, channel_values, width=max(self.plot_canvas.width(), 1))
+            (axis if channel == 0 else axis2).plot(x, y, color=colors.colors[channel % len(colors.colors)],
+                                                   label=column)
+        axis.set_xlabel('Time (min)')
+        axis.set_ylabel(self.sensor_log.columns[1])
+        axis2.set_ylabel('Irradiance (W/m2)')
+        plots.format_legend(axis, axis2, self.plot_show['Legend'])
+        self.update_plt.emit()
+
     @staticmethod
     def get_axis(ax1, ax2, string='y1'):
         if string == 'y1':
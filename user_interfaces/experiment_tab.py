@@ -4,18 +4,22 @@ import os
 from PyQt5 import QtWidgets, QtGui, QtCore
 import pyqtgraph as pg
 
+from hardware.engine import get_engine
 import hardware.keithley as keithley
 import hardware.sensor as sensor
 from user_interfaces.info_widget import InfoWidget
-from utility import serial_ports
+from utility import decimate, serial_ports
+from utility.block_average import BlockAverager
 from utility.config import defaults, paths, ports, write_config
-from utility.save_info import save_info
+from utility.render_scheduler import RenderScheduler
+from utility.save_info import save_info, save_settings
 
 pg.setConfigOption('background', 'w')
 pg.setConfigOption('foreground', 'k')
 
 
 class Experiment(QtWidgets.QWidget):
+    ports_found = QtCore.pyqtSignal(list)
 
     def __init__(self, parent=None):
         super(Experiment, self).__init__(parent)
@@ -122,6 +126,10 @@ class Experiment(QtWidgets.QWidget):
         self.sensor_avg_edit = QtWidgets.QLineEdit('1', self)
         self.sensor_avg_edit.setFixedWidth(80)
         grid_sensor_meas.addWidget(self.sensor_avg_edit, 2, 1)
+        self.sensor_log_check = QtWidgets.QCheckBox("Log to Disk", self)
+        self.sensor_log_check.setToolTip('Stream all raw and averaged sensor data of a Fixed Time run to a '
+                                         'Sensor Log folder in the save directory')
+        grid_sensor_meas.addWidget(self.sensor_log_check, 3, 0, 1, 2)
         vbox_sensor_meas.addLayout(grid_sensor_meas)
         vbox_sensor_meas.addStretch(-1)
 
@@ -240,6 +248,16 @@ class Experiment(QtWidgets.QWidget):
         self.ilimit_edit = QtWidgets.QLineEdit('%s' % defaults['iv'][4], self)
         self.ilimit_edit.setFixedWidth(60)
         grid_source.addWidget(self.ilimit_edit, 0, 5)
+        self.hw_sweep_check = QtWidgets.QCheckBox("HW Sweep", self)
+        self.hw_sweep_check.setToolTip('Let the Keithley run the sweep and read all points at the end. The '
+                                       'Keithley averages each point itself, so no current std is recorded')
+        grid_source.addWidget(self.hw_sweep_check, 1, 4)
+        self.adaptive_check = QtWidgets.QCheckBox("Adaptive", self)
+        self.adaptive_check.setToolTip('Concentrate the voltage steps where the previous curve bends')
+        grid_source.addWidget(self.adaptive_check, 1, 5)
+        self.binary_check = QtWidgets.QCheckBox("Binary", self)
+        self.binary_check.setToolTip('Store curves in the fast binary format next to the CSV files')
+        grid_source.addWidget(self.binary_check, 1, 6)
 
         self.naverage_label = QtWidgets.QLabel("Averages", self)
         grid_source.addWidget(self.naverage_label, 2, 0)
@@ -295,6 +313,7 @@ class Experiment(QtWidgets.QWidget):
         self.source_cb = QtWidgets.QComboBox()
         self.source_cb.setFixedWidth(90)
         self.source_cb.addItem('dummy')
+        self.source_cb.addItem('sim')
         self.source_cb.addItem('GPIB::24')
         for i in range(self.source_cb.count()):
             if self.source_cb.itemText(i) == ports['keithley']:
@@ -406,13 +425,24 @@ class Experiment(QtWidgets.QWidget):
         vbox_total.addLayout(hbox_bottom, 2)
         self.setLayout(vbox_total)
 
-        self.data_sensor = np.zeros((int(self.ais_edit.text()), int(self.nstep_edit.text())))
-        self.sensor_time_data = None
-        self.sensor_time_data_averaged = None
+        self.sensor_time_start = None  # sensor time of the first sample of a Fixed Time run
+        self.sensor_time_offset = None  # mean time of the first averaged block, the origin of the time axis
+        self.sensor_blocks = None  # block averaged [time, temperature, irradiance 1-4] of a Fixed Time run
+        self.sensor_sample_count = 0  # history samples of the sensor taken into the Fixed Time run
         self.sensor_time_max = None
         self.sensor_avg = None
 
+        self.renderer = RenderScheduler(parent=self)  # redraws live plots at a bounded frame rate
+        self.iv_datapoint = -1  # latest IV point announced by the Keithley
+        self.ports_found.connect(self.set_ports)
+        # plots are decimated for the visible range, so zooming or panning redraws them
+        self.sensor_graph.getViewBox().sigRangeChangedManually.connect(
+            lambda: self.renderer.request('sensor', self.render_sensor))
+        self.iv_graph.getViewBox().sigRangeChangedManually.connect(
+            lambda: self.renderer.request('iv', self.render_iv))
+
         self.sensor_mes = None
+        self.iv_mes = None
         self.start_sensor()
 
         self.iv_mes = keithley.Keithley(gpib_port='dummy')
@@ -428,13 +458,53 @@ class Experiment(QtWidgets.QWidget):
     def update_sensor(self):
         if not self.sensor_mes:
             return
-        time_val, [tval, d1val, d2val, d3val, d4val] = self.sensor_mes.get_sensor_latest()
+        if all([str(self.sensor_plot_cb.currentText()) == 'Fixed Time',
+                (self.temp_button.isChecked() or self.power_button.isChecked())]):
+            if self.sensor_time_start is None:
+                if self.check_sensor_parameters() is False:
+                    self.temp_button.setChecked(False)
+                    self.power_button.setChecked(False)
+                    return
+                self.sensor_time_start = self.sensor_mes.get_sensor_latest()[0]
+                self.sensor_time_max = float(self.sensor_time_edit.text())
+                self.sensor_avg = int(self.sensor_avg_edit.text())
+                self.sensor_blocks = BlockAverager(self.sensor_mes.n_ai + 1, self.sensor_avg)
+                self.sensor_sample_count = self.sensor_mes.get_sensor_samples()[2]  # only samples from now on
+                if self.sensor_log_check.isChecked():
+                    self.start_sensor_log()
+            times, values, self.sensor_sample_count = self.sensor_mes.get_sensor_samples(self.sensor_sample_count)
+            for time_val, sample in zip(times, values.T):
+                if (time_val - self.sensor_time_start) > self.sensor_time_max:
+                    self.temp_button.setChecked(False)
+                    self.power_button.setChecked(False)
+                    self.sensor_mes.stop_log()
+                    return
+                if self.sensor_blocks.append(np.r_[time_val, sample]):
+                    block = len(self.sensor_blocks) - 1
+                    if block == 0:
+                        self.sensor_time_offset = self.sensor_blocks.values[0, 0]
+                    self.sensor_blocks.values[0, block] -= self.sensor_time_offset  # relative to the first block
+        self.renderer.request('sensor', self.render_sensor)
+
+    def start_sensor_log(self):
+        log_directory = os.path.join(self.directory,
+                                     datetime.datetime.now().strftime('Sensor Log %Y-%m-%d %H-%M-%S'))
+        try:
+            self.sensor_mes.start_log(log_directory, block_period=self.sensor_avg * self.sensor_mes.sample_period)
+        except OSError:
+            self.logger('<span style=\" color:#ff0000;\" >Cannot create ' + log_directory +
+                        '. Sensor data is not logged.</span>')
+
+    def render_sensor(self):
+        if not self.sensor_mes:
+            return
+        _, [tval, d1val, d2val, d3val, d4val] = self.sensor_mes.get_sensor_latest()
         self.temperature_edit.setText("%.2f" % tval)
         self.diode1_edit.setText("%.1f" % d1val)
         self.diode2_edit.setText("%.1f" % d2val)
         self.diode3_edit.setText("%.1f" % d3val)
         self.diode4_edit.setText("%.1f" % d4val)
-        if str(self.sensor_plot_cb.currentText()) == 'Continuous' and not self.sensor_mes.port == 'dummy':
+        if str(self.sensor_plot_cb.currentText()) == 'Continuous':
             if self.temp_button.isChecked():
                 self.sensor_mes.line_plot(self.temp_data_line, channel='temp')
             if self.power_button.isChecked():
@@ -442,40 +512,15 @@ class Experiment(QtWidgets.QWidget):
                 self.sensor_mes.line_plot(self.power_data_line2, channel='power2')
                 self.sensor_mes.line_plot(self.power_data_line3, channel='power3')
                 self.sensor_mes.line_plot(self.power_data_line4, channel='power4')
-        elif all([str(self.sensor_plot_cb.currentText()) == 'Fixed Time',
-                  (self.temp_button.isChecked() or self.power_button.isChecked()),
-                  not self.sensor_mes.port == 'dummy']):
-            if self.sensor_time_data is None:
-                self.sensor_time_data = [[time_val], [tval], [d1val], [d2val], [d3val], [d4val]]
-                self.sensor_time_data_averaged = [[], [], [], [], [], []]
-                if self.check_sensor_parameters() is False:
-                    self.temp_button.setChecked(False)
-                    self.power_button.setChecked(False)
-                    return
-                self.sensor_time_max = float(self.sensor_time_edit.text())
-                self.sensor_avg = int(self.sensor_avg_edit.text())
-            elif (time_val - self.sensor_time_data[0][0]) > self.sensor_time_max:
-                self.temp_button.setChecked(False)
-                self.power_button.setChecked(False)
-                return
-            else:
-                latest_data = [time_val, tval, d1val, d2val, d3val, d4val]
-                for i, _ in enumerate(self.sensor_time_data):
-                    self.sensor_time_data[i].append(latest_data[i])
-                if len(self.sensor_time_data[0]) % self.sensor_avg == 0:
-                    for i, _ in enumerate(self.sensor_time_data):
-                        self.sensor_time_data_averaged[i] = \
-                            [sum(values, 0.0) / self.sensor_avg
-                             for values in zip(*[iter(self.sensor_time_data[i])] * self.sensor_avg)]
-                    self.sensor_time_data_averaged[0] = [i - self.sensor_time_data_averaged[0][0]
-                                                         for i in self.sensor_time_data_averaged[0]]
+        elif self.sensor_blocks is not None:
+            averaged = self.sensor_blocks.get_values()
             if self.temp_button.isChecked():
-                self.temp_data_line.setData(self.sensor_time_data_averaged[0], self.sensor_time_data_averaged[1])
+                decimate.set_data(self.temp_data_line, averaged[0], averaged[1])
             if self.power_button.isChecked():
-                self.power_data_line1.setData(self.sensor_time_data_averaged[0], self.sensor_time_data_averaged[2])
-                self.power_data_line2.setData(self.sensor_time_data_averaged[0], self.sensor_time_data_averaged[3])
-                self.power_data_line3.setData(self.sensor_time_data_averaged[0], self.sensor_time_data_averaged[4])
-                self.power_data_line4.setData(self.sensor_time_data_averaged[0], self.sensor_time_data_averaged[5])
+                decimate.set_data(self.power_data_line1, averaged[0], averaged[2])
+                decimate.set_data(self.power_data_line2, averaged[0], averaged[3])
+                decimate.set_data(self.power_data_line3, averaged[0], averaged[4])
+                decimate.set_data(self.power_data_line4, averaged[0], averaged[5])
 
     def start_sensor(self):
         if self.sensor_mes:
@@ -486,9 +531,12 @@ class Experiment(QtWidgets.QWidget):
                                                data_num_bytes=int(self.databytes_edit.text()),
                                                n_ai=int(self.ais_edit.text()),
                                                timeout=float(self.timeout_edit.text()),
-                                               query_period=float(self.query_edit.text()))
+                                               query_period=float(self.query_edit.text()),
+                                               engine=get_engine())
         self.sensor_register(self.sensor_mes)
         self.sensor_mes.start()
+        if self.iv_mes:
+            self.iv_mes.sensor = self.sensor_mes  # a running scan tags its curves with the new sensor
 
     def stop_sensor(self):
         self.temp_button.setChecked(False)
@@ -504,14 +552,23 @@ class Experiment(QtWidgets.QWidget):
             self.start_sensor()
 
     def update_ports(self):
-        self.stop_sensor()
+        # set_ports is called once the ports are known, the port of the running sensor is not opened
+        serial_ports.port_cache.refresh(self.ports_found.emit, in_use=[str(self.sensor_cb.currentText())])
+
+    @QtCore.pyqtSlot(list)
+    def set_ports(self, ports):
+        current_port = str(self.sensor_cb.currentText())
         self.block_sensor = True
         self.sensor_cb.clear()
         self.sensor_cb.addItem('dummy')
-        for port in serial_ports.get_serial_ports():
-            self.sensor_cb.addItem(port)
+        for port in ports:
+            if port.available:
+                self.sensor_cb.addItem(port.device)
+                self.sensor_cb.setItemData(self.sensor_cb.count() - 1, port.description, QtCore.Qt.ToolTipRole)
+        self.sensor_cb.setCurrentText(current_port)
         self.block_sensor = False
-        self.start_sensor()
+        if str(self.sensor_cb.currentText()) != current_port:  # the port of the sensor is gone
+            self.sensor_port_changed()
 
     def sensor_mode_changed(self):
         self.stop_sensor()
@@ -519,8 +576,10 @@ class Experiment(QtWidgets.QWidget):
 
     def plot_sensor(self, origin=None):
         # reset stored sensor data
-        self.sensor_time_data = None
-        self.sensor_time_data_averaged = None
+        self.sensor_time_start = None
+        self.sensor_blocks = None
+        if self.sensor_mes:
+            self.sensor_mes.stop_log()
         # Do not start fixed time measurement if iv-scan is running
         if str(self.sensor_plot_cb.currentText()) == 'Fixed Time' and self.start_button.isChecked():
             self.logger('<span style=\" color:#ff0000;\" >I-V scan is running. '
@@ -565,7 +624,6 @@ class Experiment(QtWidgets.QWidget):
         self.iv_mes = mes
         self.iv_mes.update.connect(self.update_iv)
         self.iv_mes.save_settings.connect(self.save_configuration)
-        self.iv_mes.restart_sensor.connect(self.start_sensor)
         self.iv_mes.save.connect(self.save)
         self.iv_mes.to_log.connect(self.logger)
         self.iv_mes.end_of_experiment.connect(self.experiment_loop)
@@ -586,8 +644,11 @@ class Experiment(QtWidgets.QWidget):
         elif self.check_iv_parameters() is False:
             self.start_button.setChecked(False)
             return
+        reference = None
         if self.iv_mes:
             self.iv_mes.close()
+            if self.exp_count > 0:  # the experiment loop keeps measuring the same film
+                reference = self.iv_mes.reference
         experiment_delay = 1 if self.exp_count == 0 else float(self.exp_delay_edit.text()) * 60
         self.iv_mes = keithley.Keithley(gpib_port=str(self.source_cb.currentText()),
                                         n_data_points=int(self.nstep_edit.text()),
@@ -598,9 +659,14 @@ class Experiment(QtWidgets.QWidget):
                                         experiment_delay=experiment_delay,
                                         min_voltage=float(self.start_edit.text()),
                                         max_voltage=float(self.end_edit.text()),
-                                        compliance_current=float(self.ilimit_edit.text()))
+                                        compliance_current=float(self.ilimit_edit.text()),
+                                        hardware_sweep=self.hw_sweep_check.isChecked(),
+                                        adaptive=self.adaptive_check.isChecked(),
+                                        binary_traces=self.binary_check.isChecked(),
+                                        reference=reference,
+                                        sensor=self.sensor_mes,
+                                        engine=get_engine())
         self.iv_register(self.iv_mes)
-        self.data_sensor = np.zeros((int(self.ais_edit.text()), int(self.nstep_edit.text())))
         self.check_save_path()
         if self.exp_count == 0 and int(self.exps_edit.text()) > 1:  # count file names from ' 0' if multiple
             os.rmdir(self.directory)
@@ -610,6 +676,7 @@ class Experiment(QtWidgets.QWidget):
             if not os.path.exists(self.directory):
                 os.makedirs(self.directory)
         self.info_data[0][0] = self.directory
+        self.iv_mes.trace_directory = self.directory  # curves are written point by point while measured
         self.iv_mes.read_keithley_start()
         self.exp_count += 1
 
@@ -617,10 +684,14 @@ class Experiment(QtWidgets.QWidget):
     def update_iv(self, datapoint):
         if not self.iv_mes:
             return
-        if datapoint != -1:
-            _, sensor_latest = self.sensor_mes.get_sensor_latest()
-            for ai, val in enumerate(sensor_latest):
-                self.data_sensor[ai, datapoint] = val
+        self.iv_datapoint = datapoint
+        self.renderer.request('iv', self.render_iv)
+
+    def render_iv(self):
+        if not self.iv_mes:
+            return
+        datapoint = self.iv_datapoint
+        if datapoint != -1 and datapoint < self.iv_mes.n_data_points:
             self.read_volt_edit.setText("%0.1f" % (1e3*self.iv_mes.voltages_set[datapoint]))
             self.read_curr_edit.setText("%0.2f" % (1e3*self.iv_mes.currents[datapoint]))
         self.iv_mes.line_plot(self.iv_data_line)
@@ -657,13 +728,9 @@ class Experiment(QtWidgets.QWidget):
 
     @QtCore.pyqtSlot(int)
     def save(self, repetition):
-        self.data_iv = self.iv_mes.get_keithley_data()
-        self.data_iv['Temperature (C)'] = self.data_sensor[0]
-        self.data_iv['Irradiance 1 (W/m2)'] = self.data_sensor[1]
-        self.data_iv['Irradiance 2 (W/m2)'] = self.data_sensor[2]
-        self.data_iv['Irradiance 3 (W/m2)'] = self.data_sensor[3]
-        self.data_iv['Irradiance 4 (W/m2)'] = self.data_sensor[4]
-        self.data_iv.to_csv(os.path.join(self.directory, 'IV_Curve_%s.csv' % str(repetition)))
+        self.data_iv = self.iv_mes.get_curve_data()  # sensor readings are tagged to each point by the Keithley
+        if self.iv_mes.trace_directory is None:  # otherwise the Keithley has written the curve already
+            self.data_iv.to_csv(os.path.join(self.directory, 'IV_Curve_%s.csv' % str(repetition)))
         save_info(file_path=os.path.join(self.directory, 'IV_Curve_%s.dat' % str(repetition)), folder=self.info_data[0],
                   experiment_name=self.info_data[1], experiment_date=self.info_data[2], film_id=self.info_data[3],
                   pv_cell_id=self.info_data[4], setup_location=self.info_data[5],
@@ -678,32 +745,18 @@ class Experiment(QtWidgets.QWidget):
 
     @QtCore.pyqtSlot()
     def save_configuration(self):
-        now = datetime.datetime.now()
-        save_file = open(os.path.join(self.directory, 'Settings.txt'), 'w')
-        save_file.write(now.strftime("%Y-%m-%d %H:%M:%S"))
-        save_file.write("\n\nFilm Parameters\n")
-        save_file.write("Thickness (mm): %s\n" % str(-1))
-        save_file.write("Area (cm2: %s\n" % str(-1))
-        save_file.write("\nIV Parameters\n")
-        save_file.write("Port: %s\n" % str(self.source_cb.currentText()))
-        save_file.write("Start Voltage (V): %s\n" % str(self.start_edit.text()))
-        save_file.write("End Voltage (V): %s\n" % str(self.end_edit.text()))
-        save_file.write("Voltage Step (V): %s\n" % str(self.step_edit.text()))
-        save_file.write("Number of Voltage Steps: %s\n" % str(self.nstep_edit.text()))
-        save_file.write("Current Limit (A): %s\n" % str(self.ilimit_edit.text()))
-        save_file.write("Averages per Datapoint: %s\n" % str(self.naverage_edit.text()))
-        save_file.write("Delay between Datapoints: %s\n" % str(self.delay_edit.text()))
-        save_file.write("Traces: %s\n" % str(self.reps_edit.text()))
-        save_file.write("Delay between Traces: %s\n" % str(self.rep_delay_edit.text()))
-        save_file.write("\nSensor Parameters\n")
-        save_file.write("Port: %s\n" % str(self.sensor_cb.currentText()))
-        save_file.write("Baud Rate: %s\n" % str(self.baud_edit.text()))
-        save_file.write("Bytes per Datapoint: %s\n" % str(self.databytes_edit.text()))
-        save_file.write("Datapoints: %s\n" % str(self.datapoints_edit.text()))
-        save_file.write("Analogue Inputs: %s\n" % str(self.ais_edit.text()))
-        save_file.write("Query Period (s): %s\n" % str(self.query_edit.text()))
-        save_file.write("Timeout (s): %s\n" % str(self.timeout_edit.text()))
-        save_file.close()
+        save_settings(os.path.join(self.directory, 'Settings.txt'),
+                      keithley_port=self.source_cb.currentText(), start_voltage=self.start_edit.text(),
+                      end_voltage=self.end_edit.text(), voltage_step=self.step_edit.text(),
+                      n_steps=self.nstep_edit.text(), current_limit=self.ilimit_edit.text(),
+                      averages=self.naverage_edit.text(), delay=self.delay_edit.text(),
+                      hardware_sweep=self.hw_sweep_check.isChecked(), adaptive=self.adaptive_check.isChecked(),
+                      binary_traces=self.binary_check.isChecked(), traces=self.reps_edit.text(),
+                      trace_delay=self.rep_delay_edit.text(),
+                      sensor_port=self.sensor_cb.currentText(), baud_rate=self.baud_edit.text(),
+                      data_bytes=self.databytes_edit.text(), datapoints=self.datapoints_edit.text(),
+                      analogue_inputs=self.ais_edit.text(), query_period=self.query_edit.text(),
+                      timeout=self.timeout_edit.text())
 
     def check_save_path(self):
         if any([not os.path.exists(self.directory),
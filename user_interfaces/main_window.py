@@ -2,6 +2,7 @@ import ctypes
 import os
 from PyQt5 import QtWidgets, QtGui
 
+from hardware.engine import get_engine
 from user_interfaces.table_widget import TableWidget
 from utility import config
 
@@ -29,7 +30,9 @@ class MainWindow(QtWidgets.QMainWindow):
         super(QtWidgets.QMainWindow, self).closeEvent(*args, **kwargs)
 
         # Disconnect sensor before shutdown
+        self.table_widget.tab_experiment.stop()
         self.table_widget.tab_experiment.stop_sensor()
+        get_engine().stop()
 
         # Save newly created experiment analyses
         for experiment in self.table_widget.tab_analysis.experiment_dict.values():
@@ -0,0 +1,45 @@
+import numpy as np
+
+
+class BlockAverager:
+    """
+    Averages consecutive blocks of block_size samples while they arrive.
+
+    Only the running sum of the current block is kept; each completed block adds one averaged sample to
+    preallocated arrays, which double in size when full. Appending therefore costs the same however long the run
+    is, and get_values returns views that can be handed to pyqtgraph without copying.
+    """
+    def __init__(self, n_channels=1, block_size=1, capacity=1024):
+        self.n_channels = n_channels
+        self.block_size = block_size
+        self.sums = np.zeros(n_channels)
+        self.count = 0  # samples in the current block
+        self.values = np.zeros((n_channels, max(1, capacity)))
+        self.size = 0  # number of completed blocks
+
+    def __len__(self):
+        return self.size
+
+    def append(self, values):
+        """ Adds one sample of all channels, returns True if it completed a block. """
+        self.sums += values
+        self.count += 1
+        if self.count < self.block_size:
+            return False
+        if self.size == self.values.shape[1]:
+            self.values = np.hstack([self.values, np.zeros_like(self.values)])
+        self.values[:, self.size] = self.sums / self.block_size
+        self.size += 1
+        self.sums[:] = 0.
+        self.count = 0
+        return True
+
+    def get_values(self, channel=None):
+        if channel is None:
+            return self.values[:, :self.size]
+        return self.values[channel, :self.size]
+
+    def clear(self):
+        self.sums[:] = 0.
+        self.count = 0
+        self.size = 0
@@ -1,4 +1,5 @@
 import datetime
+import functools
 import numpy as np
 
 
@@ -6,6 +7,10 @@ def digital_to_voltage(value=0, bits=10, voltage_range=5.0):
     return (value / 2**bits) * voltage_range
 
 
+def voltage_to_digital(voltage=0, bits=10, voltage_range=5.0):  # inverse of digital_to_voltage
+    return voltage / voltage_range * 2**bits
+
+
 def voltage_to_temperature_thermocouple(voltage=0):
     intrinsic_conversion = 100  # 1V = 100 C
     gain = 6.82
@@ -13,25 +18,50 @@ def voltage_to_temperature_thermocouple(voltage=0):
 
 
 def voltage_to_temperature(voltage=0, voltage_range=5.2):  # with 100kOhm thermistor
+    # accepts scalars and arrays, invalid voltages are flagged with -1
     serial_resistance = 56
-    if voltage <= 0:
-        return -1
-    try:
+    voltage = np.asarray(voltage, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
         resistance = voltage * serial_resistance / (voltage_range - voltage)
         temperature = - 21.39443 * np.log(resistance) + 123.62807
-        return temperature
-    except ZeroDivisionError:
-        return -1
+    return np.where((voltage <= 0) | (voltage == voltage_range), -1., temperature)[()]
 
 
 def voltage_to_power(voltage=0):
+    # accepts scalars and arrays, negative voltages are flagged with -1
     resistor = 390
     offset = 0.00004
     slope = 185
-    if voltage >= 0:
-        return (slope * (voltage / resistor) + offset)*1e3
-    else:
-        return -1
+    voltage = np.asarray(voltage, dtype=np.float64)
+    return np.where(voltage >= 0, (slope * (voltage / resistor) + offset)*1e3, -1.)[()]
+
+
+def temperature_to_voltage(temperature=25, voltage_range=5.2):  # inverse of voltage_to_temperature
+    serial_resistance = 56
+    resistance = np.exp((123.62807 - np.asarray(temperature, dtype=np.float64)) / 21.39443)
+    return voltage_range * resistance / (serial_resistance + resistance)
+
+
+def power_to_voltage(power=0):  # inverse of voltage_to_power
+    resistor = 390
+    offset = 0.00004
+    slope = 185
+    return (np.asarray(power, dtype=np.float64) * 1e-3 - offset) * resistor / slope
+
+
+@functools.lru_cache(maxsize=None)
+def adc_lookup_table(conversion, bits=15, voltage_range=6.144):
+    """
+    Tabulates conversion(digital_to_voltage(code)) for every 16 bit ADC code.
+
+    Index the table with the int16 codes viewed as uint16, e.g. table[codes.view(np.uint16)]. Tables are cached
+    per calibration and returned read-only.
+    """
+    codes = np.arange(2**16, dtype=np.uint16).view(np.int16)
+    table = np.asarray(conversion(digital_to_voltage(codes, bits=bits, voltage_range=voltage_range)),
+                       dtype=np.float64)
+    table.setflags(write=False)
+    return table
 
 
 def timestamp_to_datetime_hour(timestamp):
@@ -1,3 +1,4 @@
+from concurrent.futures import ProcessPoolExecutor
 import copy
 import datetime
 import numpy as np
@@ -9,7 +10,7 @@ from scipy.optimize import OptimizeWarning
 import time
 import warnings
 
-from utility import folders
+from utility import folders, trace_files
 from utility._version import __version__
 
 
@@ -23,6 +24,11 @@ average_keys = ['Time (s)', 'Open Circuit Voltage V_oc (V)', 'Short Circuit Curr
                 'Average Irradiance I_3_avg (W/m2)', 'Average Irradiance I_4_avg (W/m2)']
 
 
+def trace_signature(data_path):
+    """ Identifies the analysis of a trace: the analysis version and the signature of the files it is read from. """
+    return (__version__,) + trace_files.file_signature(data_path)
+
+
 class DataBundle:
     def __init__(self, *args, **kwargs):
         self.is_reference = False
@@ -123,43 +129,70 @@ class DataBundle:
 
 
 class Experiment(DataBundle):
-    def __init__(self, folder_path='.'):
+    def __init__(self, folder_path='.', cache_only=False):
         super().__init__(folder_path=folder_path)
 
         self.name = os.path.basename(self.folder_path)
         self.file_path = os.path.join(self.folder_path, 'experiment.pkl')
 
-        self.import_from_pickle()
+        self.is_loaded = self.import_from_pickle(cache_only)  # False if cache_only and the cache is out of date
         self.update_plot_categories()
 
-    def import_from_pickle(self):
-        n_csv = folders.get_number_of_csv(self.folder_path)
+    def import_from_pickle(self, cache_only=False):
+        """
+        Restores the analysis cached in experiment.pkl. Every trace is cached with the signature of its files, so
+        only traces that are new or whose files changed since are imported and fitted again. With cache_only
+        nothing is imported, returns False if the cache is not up to date.
+        """
+        cached_traces = {}
         if os.path.exists(self.file_path):
             try:
                 self.version, self.time, self.film_thickness, self.film_area, self.n_traces, self.traces, \
                     self.values, self.average_data, self.reference_path, self.efficiencies = self.load_pickle()
-                if any([self.version != __version__, n_csv != self.n_traces]):
-                    raise ValueError
-            except ValueError:  # mismatch in version or traces, or more parameters added since previous version
-                self.import_from_files()
-        else:
-            self.import_from_files()
+                cached_traces = {trace.data_path: trace for trace in self.traces.values()}
+            except (ValueError, EOFError, pickle.UnpicklingError):  # more parameters added since previous version
+                pass
+        trace_paths = self.get_trace_paths()
+        if len(cached_traces) == len(trace_paths) and \
+                all(self.is_cached(cached_traces, path) for _, path, _ in trace_paths):
+            return True  # nothing changed, keep the cached analysis
+        if cache_only:
+            return False
+        self.import_from_files(cached_traces)
+        return True
 
-    def import_from_files(self):
-        self.load_settings()
-        self.version = __version__
+    @staticmethod
+    def is_cached(cached_traces, data_path):
+        return data_path in cached_traces and \
+            getattr(cached_traces[data_path], 'signature', None) == trace_signature(data_path)
 
+    def get_trace_paths(self):
+        """ Key, path and class of every trace in the folder. """
         self.n_traces = folders.get_number_of_csv(self.folder_path)  # 1st par: new format, 2nd par: kickstart format
-        self.traces = {}
+        trace_paths = []
         for trace in range(self.n_traces[0]):
             key = 'IV_Curve_%s' % str(trace)
-            self.traces[key] = Trace(os.path.join(self.folder_path, key + '.csv'), self.name, key)
+            trace_paths.append((key, os.path.join(self.folder_path, key + '.csv'), Trace))
         if self.n_traces[1] > 0:  # Import Kickstart files if there are any
             kickstart_files = folders.get_kickstart_paths(self.folder_path)
             for itrace, trace in enumerate(range(self.n_traces[0], self.n_traces[0] + self.n_traces[1])):
                 key = 'IV_Curve_%s' % str(trace)
-                self.traces[key] = KickstartTrace(os.path.join(self.folder_path, kickstart_files[itrace]),
-                                                  self.name, key)
+                trace_paths.append((key, os.path.join(self.folder_path, kickstart_files[itrace]), KickstartTrace))
+        return trace_paths
+
+    def import_from_files(self, cached_traces=None):
+        """ Imports the traces of the folder, reusing those of cached_traces whose files did not change. """
+        cached_traces = cached_traces or {}
+        self.load_settings()
+        self.version = __version__
+
+        self.traces = {}
+        for key, path, trace_class in self.get_trace_paths():
+            if self.is_cached(cached_traces, path):
+                self.traces[key] = cached_traces[path]
+                self.traces[key].name, self.traces[key].experiment = key, self.name
+            else:
+                self.traces[key] = trace_class(path, self.name, key)
         self.update_average()
         self.update_fit()
         self.update_reference(None)  # set reference and efficiencies to default
@@ -238,6 +271,7 @@ class Data:
 
         self.film_thickness = -1
         self.film_area = -1
+        self.signature = trace_signature(self.data_path)  # taken before reading, so a concurrent write is seen later
         self.load_settings()
         self.data = pd.DataFrame(columns=['Index', 'Time (s)', 'Voltage (V)', 'Current (A)', 'Power (W)',
                                           'Temperature (C)', 'Irradiance 1 (W/m2)', 'Irradiance 2 (W/m2)',
@@ -355,11 +389,7 @@ class Trace(Data):
         self.csv_import()
 
     def csv_import(self):
-        self.data = pd.read_csv(self.data_path, header=None, index_col=0, skiprows=3,
-                                names=["Index", "Time (s)", "Voltage (V)", "Current (A)", "Current Std (A)",
-                                       "Resistance (Ohm)", "Power (W)", "Temperature (C)", "Irradiance 1 (W/m2)",
-                                       "Irradiance 2 (W/m2)", "Irradiance 3 (W/m2)", "Irradiance 4 (W/m2)"],
-                                usecols=[0, 1, 2, 3, 6, 7, 8, 9, 10, 11])
+        self.data = trace_files.read_trace(self.data_path)  # binary version if present, CSV otherwise
         for col in ["Temperature (C)", "Irradiance 1 (W/m2)", "Irradiance 2 (W/m2)", "Irradiance 3 (W/m2)",
                     "Irradiance 4 (W/m2)"]:
             self.fill_missing_values(col)
@@ -411,3 +441,54 @@ class KickstartTrace(Data):
         self.fitted_values['Fill Factor'] = [self.get_fill_factor(self.fitted_values['Open Circuit Voltage V_oc (V)'][0],
                                              self.fitted_values['Short Circuit Current I_sc (A)'][0],
                                              self.fitted_values['Maximum Power P_max (W)'][0]), 0]
+
+
+def load_bundle(path):
+    """ Group of a .gpkl file or Experiment of a folder, fully analysed. """
+    if path.endswith('.gpkl'):
+        return Group(path)
+    return Experiment(path)
+
+
+def summarise(bundle):
+    """ Compact summary of an Experiment or Group: its metadata and analysed values without the trace data. """
+    return {'name': bundle.name, 'folder_path': bundle.folder_path, 'file_path': bundle.file_path,
+            'time': bundle.time, 'film_thickness': bundle.film_thickness, 'film_area': bundle.film_area,
+            'n_traces': bundle.n_traces, 'values': bundle.values, 'fitted_values': bundle.fitted_values}
+
+
+def load_summary(path):
+    return summarise(load_bundle(path))
+
+
+def load_cached(path):
+    """ Group of a .gpkl file or Experiment of a folder if it is fully cached, None if traces need importing. """
+    if path.endswith('.gpkl'):
+        return Group(path)  # groups only exist as pickles
+    experiment = Experiment(path, cache_only=True)
+    return experiment if experiment.is_loaded else None
+
+
+def load_bundles(paths, max_workers=None, summaries=False):
+    """
+    Loads the Experiments and Groups of paths, returns them in a dictionary keyed by path.
+
+    Groups and experiments with an up-to-date cache are restored in this process, which takes milliseconds. Only
+    the folders whose traces have to be parsed and fitted, which is CPU bound, are loaded in parallel worker
+    processes and sent back pickled. With summaries only the result of summarise is returned, which is much
+    smaller to send. A single folder is loaded in this process, where starting workers would cost more than it
+    saves.
+    """
+    paths = list(paths)
+    bundles = {path: load_cached(path) for path in paths}
+    uncached = [path for path, bundle in bundles.items() if bundle is None]
+    if summaries:
+        bundles = {path: None if bundle is None else summarise(bundle) for path, bundle in bundles.items()}
+    load = load_summary if summaries else load_bundle
+    max_workers = min(len(uncached), max_workers or os.cpu_count() or 1)
+    if max_workers <= 1:
+        bundles.update((path, load(path)) for path in uncached)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            bundles.update(zip(uncached, executor.map(load, uncached)))
+    return bundles
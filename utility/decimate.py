@@ -0,0 +1,62 @@
+import numpy as np
+
+POINTS_PER_PIXEL = 2  # curves with up to this many points per pixel of the view are drawn as they are
+DEFAULT_WIDTH = 1000  # pixels assumed for a view that is not shown yet
+
+
+def visible(x, x_range):
+    """ Slice of the ascending x inside x_range, with one point to either side so lines run to the view edges. """
+    first = max(np.searchsorted(x, x_range[0], side='left') - 1, 0)
+    last = min(np.searchsorted(x, x_range[1], side='right') + 1, x.size)
+    return slice(first, last)
+
+
+def min_max(x, y, n_bins, ascending=True):
+    """
+    Min-max envelope of a curve: the lowest and the highest value of every bin, at the first and the last x of the
+    bin. Bins have equal widths in x for an ascending x and an equal number of points otherwise. Spikes survive
+    at any level, since every extreme value is kept.
+    """
+    if ascending:
+        starts = np.searchsorted(x, np.linspace(x[0], x[-1], n_bins + 1)[:-1], side='left')
+    else:
+        starts = np.linspace(0, x.size, n_bins, endpoint=False).astype(np.int64)
+    starts = np.unique(starts)  # empty bins share their start with the next one
+    ends = np.r_[starts[1:], x.size] - 1
+    xs = np.column_stack([x[starts], x[ends]]).ravel()
+    ys = np.column_stack([np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts)]).ravel()
+    return xs, ys
+
+
+def decimate(x, y, x_range=None, width=DEFAULT_WIDTH):
+    """
+    Reduces a curve to what a view of width pixels showing x_range (all of it for None) can display.
+
+    Points outside x_range are dropped if x is ascending, and the rest is reduced to a min-max envelope with one
+    bin per pixel if it holds more than POINTS_PER_PIXEL points per pixel. Short curves are returned unchanged.
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if x.size <= POINTS_PER_PIXEL * width:
+        return x, y
+    ascending = bool(np.all(x[1:] >= x[:-1]))
+    if ascending and x_range is not None:
+        window = visible(x, x_range)
+        x, y = x[window], y[window]
+        if x.size <= POINTS_PER_PIXEL * width:
+            return x, y
+    return min_max(x, y, width, ascending)
+
+
+def set_data(line, x, y):
+    """
+    Sets the data of a pyqtgraph line decimated for its view.
+
+    While the view follows the data (x auto range) the whole curve is decimated, otherwise only its visible part,
+    so zooming in reveals the full resolution. Call again after the view range changed.
+    """
+    view = line.getViewBox()
+    if view is None:
+        line.setData(x, y)
+        return
+    x_range = None if view.autoRangeEnabled()[0] else view.viewRange()[0]
+    line.setData(*decimate(x, y, x_range, int(view.width()) or DEFAULT_WIDTH))
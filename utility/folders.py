@@ -21,10 +21,11 @@ def get_csv_folders(path):
     path_list = list()
     if os.path.isfile(path):
         return []
-    # add dir to pathlist if it contains .txt files
+    # add dir to pathlist if it contains trace files
     if len([f for f in os.listdir(path)
-            if f.endswith('.csv') and (os.path.basename(f).startswith('IV_Curve_') or
-                                       os.path.basename(f).startswith('IV Characterizer'))]) > 0:
+            if (f.endswith('.csv') and (os.path.basename(f).startswith('IV_Curve_') or
+                                        os.path.basename(f).startswith('IV Characterizer'))) or
+            (f.endswith('.npz') and os.path.basename(f).startswith('IV_Curve_'))]) > 0:
         path_list.append(os.path.normpath(path))
     for d in os.listdir(path):
         new_path = os.path.join(path, d)
@@ -39,14 +40,16 @@ def get_kickstart_paths(path):
 
 
 def get_number_of_csv(path):
-    # returns number of csv files in the directory
+    # returns number of traces in the directory, an IV curve counts once whether it is stored as csv, npz or both
     n_csv = [0, 0]
     if os.path.isdir(path):
+        iv_curves = set()
         for entry in os.scandir(path):
-            if os.path.basename(entry).startswith('IV_Curve_') and entry.path.endswith(".csv"):
-                n_csv[0] += 1
+            if os.path.basename(entry).startswith('IV_Curve_') and entry.path.endswith((".csv", ".npz")):
+                iv_curves.add(os.path.splitext(entry.name)[0])
             elif os.path.basename(entry).startswith('IV Characterizer') and entry.path.endswith(".csv"):
                 n_csv[1] += 1
+        n_csv[0] = len(iv_curves)
         return n_csv
     else:
         return [-1, -1]
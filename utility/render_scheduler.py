@@ -0,0 +1,45 @@
+from PyQt5 import QtCore
+import time
+
+MAX_FPS = 30.0  # highest redraw rate of the live plots
+
+
+class RenderScheduler(QtCore.QObject):
+    """
+    Coalesces redraw requests of the GUI thread and runs them at a bounded frame rate.
+
+    Sources call request(key, callback) as often as data arrives. Requests with the same key replace each other
+    until the next frame, so every callback runs at most once per frame however many points or sensor ticks
+    arrived meanwhile. A request after an idle period is drawn without delay.
+    """
+    def __init__(self, max_fps=MAX_FPS, parent=None):
+        super(RenderScheduler, self).__init__(parent)
+        self.frame_period = 1.0 / max_fps
+        self.pending = {}  # key: callback, drawn in the order of the first request
+        self.last_frame = 0.
+        self.frames = 0
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.render)
+
+    def request(self, key, callback):
+        self.pending[key] = callback
+        if not self.timer.isActive():
+            wait = max(0., self.last_frame + self.frame_period - time.monotonic())
+            self.timer.start(int(round(1e3 * wait)))
+
+    def cancel(self, key):
+        self.pending.pop(key, None)
+
+    def render(self):
+        pending, self.pending = self.pending, {}
+        self.last_frame = time.monotonic()
+        for callback in pending.values():
+            callback()
+        self.frames += 1
+
+    def flush(self):
+        """ Draws all pending requests right away. """
+        self.timer.stop()
+        if self.pending:
+            self.render()
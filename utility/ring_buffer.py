@@ -0,0 +1,76 @@
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Preallocated multi-channel history with a shared time axis.
+
+    Every sample is written twice, at its slot and one capacity further on, so the latest samples are always
+    available as one contiguous slice. get_times and get_values therefore return views that can be handed to
+    pyqtgraph or pandas without copying.
+    """
+    def __init__(self, n_channels=1, capacity=100, dtype=np.float64):
+        self.n_channels = n_channels
+        self.capacity = capacity
+        self.times = np.zeros(2 * self.capacity)
+        self.values = np.zeros((self.n_channels, 2 * self.capacity), dtype=dtype)
+        self.index = 0  # slot the next sample is written to
+        self.size = 0  # number of valid samples
+        self.count = 0  # number of samples written since creation
+
+    def __len__(self):
+        return self.size
+
+    def append(self, time_value, values):
+        self.times[self.index] = self.times[self.index + self.capacity] = time_value
+        self.values[:, self.index] = self.values[:, self.index + self.capacity] = values
+        self.index = (self.index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.count += 1
+
+    def extend(self, times, values):
+        """ Append a block of samples, values has the shape (n_channels, n_samples). """
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values).reshape(self.n_channels, -1)
+        n_samples = times.size
+        if n_samples == 0:
+            return
+        self.count += n_samples
+        if n_samples > self.capacity:  # only the most recent samples fit
+            times, values = times[-self.capacity:], values[:, -self.capacity:]
+            self.index = (self.index + n_samples - self.capacity) % self.capacity
+            n_samples = self.capacity
+        slots = (self.index + np.arange(n_samples)) % self.capacity
+        self.times[slots] = self.times[slots + self.capacity] = times
+        self.values[:, slots] = self.values[:, slots + self.capacity] = values
+        self.index = (self.index + n_samples) % self.capacity
+        self.size = min(self.size + n_samples, self.capacity)
+
+    def window(self, n_samples=None):
+        n_samples = self.size if n_samples is None else min(n_samples, self.size)
+        end = self.index + self.capacity
+        return slice(end - n_samples, end)
+
+    def get_times(self, n_samples=None):
+        return self.times[self.window(n_samples)]
+
+    def get_values(self, channel=None, n_samples=None):
+        if channel is None:
+            return self.values[:, self.window(n_samples)]
+        return self.values[channel, self.window(n_samples)]
+
+    def between(self, start, end):
+        """ Returns the times and values of the samples with start <= time <= end, times must be ascending. """
+        window = self.window()
+        times = self.times[window]
+        first, last = np.searchsorted(times, start, side='left'), np.searchsorted(times, end, side='right')
+        return times[first:last], self.values[:, window][:, first:last]
+
+    def latest(self):
+        """ Returns the time and channel values of the most recent sample. """
+        last = self.index + self.capacity - 1
+        return self.times[last], self.values[:, last]
+
+    def clear(self):
+        self.index = 0
+        self.size = 0
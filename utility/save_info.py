@@ -14,3 +14,30 @@ info_defaults = [['.'], ['N/A'], [datetime.date.today()], ['unknown'], ['unknown
 def save_info(file_path='.', **kwargs):
     df = pd.DataFrame({par: kwargs.get(par, info_defaults[i]) for i, par in enumerate(info_pars)})
     df.to_csv(file_path)
+
+
+settings_pars = [('IV Parameters', [('keithley_port', 'Port'), ('start_voltage', 'Start Voltage (V)'),
+                                    ('end_voltage', 'End Voltage (V)'), ('voltage_step', 'Voltage Step (V)'),
+                                    ('n_steps', 'Number of Voltage Steps'), ('current_limit', 'Current Limit (A)'),
+                                    ('averages', 'Averages per Datapoint'),
+                                    ('delay', 'Delay between Datapoints'), ('hardware_sweep', 'Hardware Sweep'),
+                                    ('adaptive', 'Adaptive Steps'), ('binary_traces', 'Binary Traces'),
+                                    ('traces', 'Traces'),
+                                    ('trace_delay', 'Delay between Traces')]),
+                 ('Sensor Parameters', [('sensor_port', 'Port'), ('baud_rate', 'Baud Rate'),
+                                        ('data_bytes', 'Bytes per Datapoint'), ('datapoints', 'Datapoints'),
+                                        ('analogue_inputs', 'Analogue Inputs'), ('query_period', 'Query Period (s)'),
+                                        ('timeout', 'Timeout (s)')])]
+
+
+def save_settings(file_path='Settings.txt', **kwargs):
+    """ Writes the measurement settings in the layout of Settings.txt that DataBundle.load_settings reads. """
+    with open(file_path, 'w') as save_file:
+        save_file.write(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        save_file.write("\n\nFilm Parameters\n")
+        save_file.write("Thickness (mm): %s\n" % str(kwargs.get('film_thickness', -1)))
+        save_file.write("Area (cm2: %s\n" % str(kwargs.get('film_area', -1)))
+        for section, pars in settings_pars:
+            save_file.write("\n%s\n" % section)
+            for par, label in pars:
+                save_file.write("%s: %s\n" % (label, str(kwargs.get(par, ''))))
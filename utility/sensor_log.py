@@ -0,0 +1,167 @@
+from configparser import ConfigParser
+import glob
+import numpy as np
+import os
+import queue
+import threading
+import time
+
+LOG_INFO = 'sensor_log.ini'  # describes the columns and streams of a log directory
+STREAMS = ('raw', 'averaged')  # every received frame, and the frames averaged over block_period
+CHUNK_ROWS = 2 ** 20  # rows per chunk file, 48 MB with six float64 columns
+CHUNK_PATTERN = '%s_%06d.bin'
+
+
+def chunk_paths(directory, stream):
+    return sorted(glob.glob(os.path.join(directory, '%s_*.bin' % stream)))
+
+
+class SensorLog:
+    """
+    Streams sensor frames to disk for runs of any length.
+
+    Each stream is a sequence of chunk files of at most chunk_rows rows. A row is [time, channel 0, ...] as float64,
+    and rows are only ever appended, so a chunk is a plain array that can be memory mapped while it grows. The
+    'raw' stream holds every frame, the 'averaged' stream the mean of the frames in consecutive windows of
+    block_period seconds. Only the frames of the current averaging window are kept in memory. The files are
+    written by a thread of the log, append only queues the frames, so acquisition never waits for the disk.
+    """
+    def __init__(self, directory, columns, block_period=1.0, chunk_rows=CHUNK_ROWS, sync_period=1.0,
+                 time_origin=None):
+        os.makedirs(directory)
+        self.directory = directory
+        self.columns = list(columns)  # time column first
+        self.block_period = block_period
+        self.chunk_rows = chunk_rows
+        self.sync_period = sync_period
+        self.last_sync = time.monotonic()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.pending = np.zeros((0, len(self.columns)))  # frames of the averaging window still being filled
+        self.files = {stream: None for stream in STREAMS}
+        self.chunks = {stream: -1 for stream in STREAMS}
+        self.rows = {stream: 0 for stream in STREAMS}  # rows in the current chunk
+        self.queue = queue.Queue()  # blocks of rows for the writer thread, None once closed
+        info = ConfigParser()
+        info['log'] = {'columns': ','.join(self.columns), 'block_period': repr(block_period),
+                       'chunk_rows': str(chunk_rows),
+                       'time_origin': repr(time.time() if time_origin is None else time_origin)}
+        with open(os.path.join(directory, LOG_INFO), 'w') as f:
+            info.write(f)
+        self.thread = threading.Thread(target=self.write_thread, name='sensor log', daemon=True)
+        self.thread.start()
+
+    def append(self, times, values):
+        """ Queues a block of frames for writing, values has the shape (n_channels, n_frames). Ignored once closed. """
+        rows = np.column_stack([np.asarray(times, dtype=np.float64), np.asarray(values, dtype=np.float64).T])
+        with self.lock:
+            if self.closed or rows.shape[0] == 0:
+                return
+            self.queue.put(rows)
+
+    def write_thread(self):
+        while True:
+            rows = self.queue.get()
+            if rows is None:
+                return
+            self.write('raw', rows)
+            self.write('averaged', self.average(rows))
+            if time.monotonic() - self.last_sync >= self.sync_period:
+                self.sync()
+
+    def average(self, rows):
+        """ Means of the averaging windows completed by rows, the frames of the last window are kept. """
+        rows = np.vstack([self.pending, rows])
+        windows = np.floor(rows[:, 0] / self.block_period)
+        complete = np.searchsorted(windows, windows[-1], side='left')
+        self.pending = rows[complete:]
+        if complete == 0:
+            return rows[:0]
+        starts = np.flatnonzero(np.r_[True, windows[1:complete] != windows[:complete - 1]])
+        counts = np.diff(np.r_[starts, complete])
+        return np.add.reduceat(rows[:complete], starts, axis=0) / counts[:, np.newaxis]
+
+    def write(self, stream, rows):
+        while rows.shape[0] > 0:
+            if self.files[stream] is None or self.rows[stream] == self.chunk_rows:
+                self.next_chunk(stream)
+            n_rows = min(rows.shape[0], self.chunk_rows - self.rows[stream])
+            self.files[stream].write(np.ascontiguousarray(rows[:n_rows]).tobytes())
+            self.rows[stream] += n_rows
+            rows = rows[n_rows:]
+
+    def next_chunk(self, stream):
+        if self.files[stream] is not None:
+            self.files[stream].close()
+        self.chunks[stream] += 1
+        self.rows[stream] = 0
+        self.files[stream] = open(os.path.join(self.directory, CHUNK_PATTERN % (stream, self.chunks[stream])), 'wb')
+
+    def sync(self):
+        for f in self.files.values():
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        """ Writes the queued frames and the average of the last, incomplete window, then closes the chunk files. """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join()
+        if self.pending.shape[0] > 0:
+            self.write('averaged', self.pending.mean(axis=0, keepdims=True))
+        self.sync()
+        for f in self.files.values():
+            if f is not None:
+                f.close()
+
+
+class SensorLogReader:
+    """
+    Reads time windows of a log written by SensorLog without loading it.
+
+    Chunks are memory mapped, so only the pages of the requested window are read from disk. The log can be read
+    while it is still being written, rows show up once SensorLog has flushed them (at most every sync_period).
+    """
+    def __init__(self, directory):
+        info = ConfigParser()
+        if not info.read(os.path.join(directory, LOG_INFO)):
+            raise ValueError('%s is not a sensor log.' % directory)
+        self.directory = directory
+        self.columns = info['log']['columns'].split(',')
+        self.block_period = info['log'].getfloat('block_period')
+        self.time_origin = info['log'].getfloat('time_origin')  # epoch time of time 0 of the log
+
+    def chunks(self, stream='raw'):
+        """ Memory maps of the chunks of a stream with the shape (n_rows, n_columns). """
+        row_size = len(self.columns) * 8
+        maps = []
+        for path in chunk_paths(self.directory, stream):
+            n_rows = os.path.getsize(path) // row_size  # a row may be half written
+            if n_rows > 0:
+                maps.append(np.memmap(path, dtype=np.float64, mode='r', shape=(n_rows, len(self.columns))))
+        return maps
+
+    def time_range(self, stream='raw'):
+        """ Times of the first and the last row of a stream, None for an empty stream. """
+        chunks = self.chunks(stream)
+        if not chunks:
+            return None
+        return float(chunks[0][0, 0]), float(chunks[-1][-1, 0])
+
+    def read_window(self, start=None, end=None, stream='raw'):
+        """ Times and channel values (n_channels, n_rows) of the rows with start <= time <= end, as copies. """
+        parts = []
+        for chunk in self.chunks(stream):
+            if (start is not None and chunk[-1, 0] < start) or (end is not None and chunk[0, 0] > end):
+                continue
+            times = chunk[:, 0]
+            first = 0 if start is None else np.searchsorted(times, start, side='left')
+            last = chunk.shape[0] if end is None else np.searchsorted(times, end, side='right')
+            parts.append(np.array(chunk[first:last]))
+        rows = np.vstack(parts) if parts else np.zeros((0, len(self.columns)))
+        return rows[:, 0], np.ascontiguousarray(rows[:, 1:].T)
@@ -1,32 +1,119 @@
-import sys
-import glob
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
 import serial
+from serial.tools import list_ports
+import threading
+import time
 
+from hardware.arduino_ai import FRAME_SYNC
+
+PROBE_TIMEOUT = 0.5  # seconds all ports together may take to open
+IDENTIFY_TIMEOUT = 2.5  # seconds to wait for frames, opening the port resets the Arduino which boots in about 2 s
+ARDUINO_USB_IDS = {0x2341, 0x2a03, 0x1a86, 0x0403, 0x10c4}  # Arduino, Arduino.org, CH340, FTDI and CP210x bridges
+
+PortInfo = namedtuple('PortInfo', ['device', 'description', 'vid', 'pid', 'available', 'arduino'])
+
+
+def probe(device):
+    """ Returns True if the port can be opened. """
+    try:
+        serial.Serial(device).close()
+    except (OSError, serial.SerialException):
+        return False
+    return True
+
+
+def identify(device, baud=38400, timeout=IDENTIFY_TIMEOUT):
+    """ Identify handshake, returns True if the port delivers the frames of sensor_adc.ino within timeout. """
+    try:
+        connection = serial.Serial(device, baud, timeout=0.1)
+    except (OSError, serial.SerialException):
+        return False
+    received = bytearray()
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            received += connection.read(max(1, connection.in_waiting))
+            if FRAME_SYNC in received:
+                return True
+    except (OSError, serial.SerialException):
+        pass
+    finally:
+        connection.close()
+    return False
 
-def get_serial_ports():
-    """ Lists serial port names
 
-        :raises EnvironmentError:
-            On unsupported or unknown platforms
-        :returns:
-            A list of the serial ports available on the system
+def check_port(port, identify_arduino=False, baud=38400):
+    if identify_arduino:
+        found = identify(port.device, baud)
+        return port._replace(available=found or probe(port.device), arduino=found)
+    return port._replace(available=probe(port.device))
+
+
+def discover(check=True, identify_arduino=False, baud=38400, timeout=PROBE_TIMEOUT, in_use=()):
+    """
+    Lists the serial ports of the system with their USB metadata.
+
+    Ports are taken from the enumeration of the operating system, which costs milliseconds, instead of trying to
+    open every possible device name. With check they are opened in parallel to see whether they are available.
+    Ports that do not answer within timeout (plus IDENTIFY_TIMEOUT with identify_arduino) are reported as
+    unavailable. Boards with the USB vendor id of an Arduino or a common USB serial bridge are marked as arduino,
+    with identify_arduino only those that send sensor frames. The ports in_use are reported as available without
+    opening them, as opening a port resets the Arduino connected to it.
     """
-    if sys.platform.startswith('win'):
-        ports = ['COM%s' % (i + 1) for i in range(256)]
-    elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-        # this excludes your current terminal "/dev/tty"
-        ports = glob.glob('/dev/tty[A-Za-z]*')
-    elif sys.platform.startswith('darwin'):
-        ports = glob.glob('/dev/tty.*')
-    else:
-        raise EnvironmentError('Unsupported platform')
-
-    result = []
-    for port in ports:
-        try:
-            s = serial.Serial(port)
-            s.close()
-            result.append(port)
-        except (OSError, serial.SerialException):
-            pass
-    return result
+    ports = [PortInfo(info.device, info.description, info.vid, info.pid, None, info.vid in ARDUINO_USB_IDS)
+             for info in sorted(list_ports.comports(), key=lambda info: info.device)]
+    if not check or not ports:
+        return ports
+    executor = ThreadPoolExecutor(max_workers=len(ports), thread_name_prefix='port probe')
+    futures = [None if port.device in in_use else executor.submit(check_port, port, identify_arduino, baud)
+               for port in ports]
+    wait([future for future in futures if future is not None], timeout + (IDENTIFY_TIMEOUT if identify_arduino else 0.))
+    executor.shutdown(wait=False)  # a hanging port does not hold up the result
+    return [port._replace(available=True) if future is None else
+            future.result() if future.done() else port._replace(available=False)
+            for port, future in zip(ports, futures)]
+
+
+class PortCache:
+    """
+    Result of discover, refreshed in a background thread.
+
+    get returns the cached ports at once. Only the first call, before any result is there, runs discover itself.
+    """
+    def __init__(self, **discover_kwargs):
+        self.discover_kwargs = discover_kwargs
+        self.ports = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def get(self):
+        with self.lock:
+            if self.ports is None:
+                self.update()
+            return self.ports
+
+    def update(self, in_use=()):
+        self.ports = discover(in_use=in_use, **self.discover_kwargs)
+
+    def refresh(self, callback=None, in_use=()):
+        """ Rediscovers the ports in the background, then calls callback with them. """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.refresh_thread, args=(callback, in_use), daemon=True)
+        self.thread.start()
+
+    def refresh_thread(self, callback, in_use):
+        with self.lock:
+            self.update(in_use)
+            ports = self.ports
+        if callback is not None:
+            callback(ports)
+
+
+port_cache = PortCache()
+
+
+def get_serial_ports():
+    """ Names of the serial ports available on the system, from the cache of port_cache. """
+    return [port.device for port in port_cache.get() if port.available]
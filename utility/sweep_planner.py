@@ -0,0 +1,109 @@
+import numpy as np
+from scipy.interpolate import PchipInterpolator
+from scipy.signal import savgol_filter
+
+from utility.trace_files import SKIPPED_POINTS
+
+ISC_FIT_POINTS = 3  # points after the one closest to 0 V that Trace.fit_isc uses
+
+
+def cumulative_integral(values, grid):
+    """ Running trapezoidal integral of values over grid, starting at zero. """
+    return np.concatenate([[0.], np.cumsum((values[1:] + values[:-1]) / 2 * np.diff(grid))])
+
+
+def coarse_voltages(min_voltage, max_voltage, n_data_points, fraction=0.25, min_points=10):
+    """ Evenly spaced voltages of a quick pass that serves as reference when no previous curve exists. """
+    return np.linspace(min_voltage, max_voltage, num=max(min_points, int(fraction * n_data_points)))
+
+
+def curve_shape(voltages, currents, n_grid=512):
+    """
+    Arc length density and curvature of an IV curve on a fine voltage grid.
+
+    Voltage and current are scaled to unit ranges first so that the knee around P_max and the steep part
+    around V_oc stand out against the flat part. Long curves are smoothed with a Savitzky-Golay filter before
+    interpolation to keep measurement noise out of the second derivative.
+    """
+    order = np.argsort(voltages)
+    voltages, unique = np.unique(np.asarray(voltages, dtype=float)[order], return_index=True)
+    currents = np.asarray(currents, dtype=float)[order][unique]
+    grid = np.linspace(voltages[0], voltages[-1], n_grid)
+    if voltages.size < 4:
+        return grid, np.ones_like(grid), np.zeros_like(grid)
+    v_range = voltages[-1] - voltages[0]
+    i_range = np.ptp(currents) or 1.
+    scaled = (currents - currents.min()) / i_range
+    if voltages.size >= 15:
+        scaled = savgol_filter(scaled, 2 * (voltages.size // 20) + 5, 3)
+    interpolator = PchipInterpolator((voltages - voltages[0]) / v_range, scaled)
+    x = (grid - grid[0]) / v_range
+    slope, bend = interpolator.derivative(1)(x), interpolator.derivative(2)(x)
+    arc_length = np.sqrt(1 + slope ** 2)
+    curvature = np.abs(bend) / arc_length ** 3
+    kernel = np.hanning(n_grid // 25 + 3)
+    return grid, arc_length, np.convolve(curvature, kernel / kernel.sum(), mode='same')
+
+
+def leading_voltages(min_voltage, max_voltage, n_data_points, isc_step=2e-3):
+    """
+    Evenly spaced voltages at the start of a sweep, dense around 0 V for the I_sc fit.
+
+    They cover the SKIPPED_POINTS points that Trace ignores, 0 V itself if it lies in the range, and ISC_FIT_POINTS
+    points above, at most isc_step apart next to 0 V. Returns an empty array if they do not fit into the sweep.
+    """
+    if min_voltage < 0:
+        n_below = max(SKIPPED_POINTS + 1, min(int(round(-min_voltage / isc_step)), n_data_points // 4))  # steps to 0 V
+        below = np.linspace(min_voltage, 0., n_below + 1)
+        leading = np.r_[below, min(below[1] - below[0], isc_step) * np.arange(1, ISC_FIT_POINTS + 1)]
+    else:
+        leading = min_voltage + isc_step * np.arange(SKIPPED_POINTS + ISC_FIT_POINTS + 1)
+    if leading.size + 2 > n_data_points or leading[-1] >= max_voltage:
+        return np.zeros(0)
+    return leading
+
+
+def plan_voltages(voltages, currents, n_data_points, min_voltage=None, max_voltage=None, weights=(0.1, 0.6, 0.3),
+                  min_step=1e-3):
+    """
+    Voltages for the next sweep, concentrated where a reference IV curve is steep or bends.
+
+    The reference can be a coarse pass or the previous curve of the same film. The sweep starts with the
+    leading_voltages around 0 V, so that I_sc is measured as on an even grid. weights split the remaining points
+    between an even spread (flat part), equal steps along the curve (steep part, V_oc fit) and curvature (knee,
+    P_max fit). No two points are placed closer than about min_step, and the first and last point are always
+    min_voltage and max_voltage.
+    """
+    min_voltage = np.min(voltages) if min_voltage is None else min_voltage
+    max_voltage = np.max(voltages) if max_voltage is None else max_voltage
+    if n_data_points < 3 or max_voltage <= min_voltage:
+        return np.linspace(min_voltage, max_voltage, num=n_data_points)
+    leading = leading_voltages(min_voltage, max_voltage, n_data_points)
+    if leading.size == 0:
+        return distribute(voltages, currents, n_data_points, min_voltage, max_voltage, weights, min_step)
+    rest = distribute(voltages, currents, n_data_points - leading.size + 1, leading[-1], max_voltage, weights,
+                      min_step)
+    return np.r_[leading, rest[1:]]
+
+
+def distribute(voltages, currents, n_data_points, min_voltage, max_voltage, weights, min_step):
+    """ n_data_points voltages from min_voltage to max_voltage following the weighted density of plan_voltages. """
+    reference_grid, arc_length, curvature = curve_shape(voltages, currents)
+    grid = np.linspace(min_voltage, max_voltage, reference_grid.size)
+    density = np.zeros_like(grid)
+    for weight, shape in zip(weights, (np.ones_like(grid), arc_length, curvature)):
+        shape = np.interp(grid, reference_grid, shape)
+        total = cumulative_integral(shape, grid)[-1]
+        if total > 0:
+            density += weight * shape / total
+    cap = 1. / (n_data_points * min_step)  # highest density that keeps points min_step apart
+    for _ in range(10):
+        density = np.minimum(density, cap)
+        density /= cumulative_integral(density, grid)[-1]
+        if density.max() <= cap * 1.001:
+            break
+    cumulative = cumulative_integral(density, grid)
+    cumulative /= cumulative[-1]
+    planned = np.interp(np.linspace(0, 1, n_data_points), cumulative, grid)
+    planned[0], planned[-1] = min_voltage, max_voltage
+    return planned
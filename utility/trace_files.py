@@ -0,0 +1,109 @@
+import argparse
+import numpy as np
+import os
+import pandas as pd
+
+BINARY_SUFFIX = '.npz'
+CURVE_COLUMNS = ['Time (s)', 'Voltage (V)', 'Current (A)', 'Current Std (A)', 'Resistance (Ohm)', 'Power (W)',
+                 'Temperature (C)', 'Irradiance 1 (W/m2)', 'Irradiance 2 (W/m2)', 'Irradiance 3 (W/m2)',
+                 'Irradiance 4 (W/m2)']  # columns of IV_Curve_*.csv after the index
+TRACE_COLUMNS = ['Time (s)', 'Voltage (V)', 'Current (A)', 'Power (W)', 'Temperature (C)', 'Irradiance 1 (W/m2)',
+                 'Irradiance 2 (W/m2)', 'Irradiance 3 (W/m2)', 'Irradiance 4 (W/m2)']  # columns used by Trace
+SKIPPED_POINTS = 2  # leading points of each curve that Trace ignores, as in the CSV import
+
+
+def binary_path(file_path):
+    return os.path.splitext(file_path)[0] + BINARY_SUFFIX
+
+
+def file_signature(file_path):
+    """
+    Size and modification time of the files a trace is read from: the CSV, its binary version and the Settings.txt
+    of its folder, None for a missing file. Any change to them changes the signature.
+    """
+    signature = []
+    for path in (file_path, binary_path(file_path), os.path.join(os.path.dirname(file_path), 'Settings.txt')):
+        try:
+            stat = os.stat(path)
+            signature.append((stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def write_binary(file_path, data):
+    """
+    Stores the curve DataFrame data as an uncompressed .npz next to file_path.
+
+    The file holds the index, the column names and one float64 array of shape (n_columns, n_points), so every
+    column is contiguous and loading is a plain memory copy.
+    """
+    path = binary_path(file_path)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        np.savez(f, index=np.asarray(data.index, dtype=np.int64), columns=np.array(data.columns, dtype=str),
+                 values=np.ascontiguousarray(data.to_numpy(dtype=np.float64).T))
+    os.replace(temporary_path, path)
+    return path
+
+
+def read_binary(file_path):
+    """ Curve of a .npz written by write_binary as a DataFrame, in the layout of reading the CSV with index_col=0. """
+    index, columns, values = load_binary(file_path)
+    return pd.DataFrame(values.T, columns=columns, index=index)
+
+
+def load_binary(file_path):
+    """ Index, column names and column values of a .npz written by write_binary. """
+    with np.load(binary_path(file_path), allow_pickle=False) as f:
+        return f['index'], list(f['columns']), f['values']
+
+
+def is_binary_current(file_path):
+    """ True if the binary version of file_path exists and is not older than the CSV (if there is a CSV). """
+    target = binary_path(file_path)
+    if not os.path.exists(target):
+        return False
+    return not os.path.exists(file_path) or os.path.getmtime(target) >= os.path.getmtime(file_path)
+
+
+def read_trace(file_path):
+    """
+    Data of a trace as imported by Trace: the columns TRACE_COLUMNS without the first SKIPPED_POINTS points and
+    indexed by 'Index'. The binary version of the file is used if it is up to date, otherwise the CSV is parsed.
+    """
+    if is_binary_current(file_path):
+        index, columns, values = load_binary(file_path)
+        column_values = [values[columns.index(column), SKIPPED_POINTS:] if column in columns
+                         else np.full(index.size - SKIPPED_POINTS, np.nan) for column in TRACE_COLUMNS]
+        return pd.DataFrame(np.column_stack(column_values), columns=TRACE_COLUMNS,
+                            index=pd.Index(index[SKIPPED_POINTS:], name='Index'))
+    return pd.read_csv(file_path, header=None, index_col=0, skiprows=SKIPPED_POINTS + 1,
+                       names=['Index'] + CURVE_COLUMNS, usecols=[0, 1, 2, 3, 6, 7, 8, 9, 10, 11])
+
+
+def convert_folder(path, remove_csv=False, recursive=True):
+    """ Writes a binary version of every IV_Curve_*.csv below path that has none or an outdated one. """
+    converted = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            if not (filename.startswith('IV_Curve_') and filename.endswith('.csv')):
+                continue
+            file_path = os.path.join(dirpath, filename)
+            if not is_binary_current(file_path):
+                converted.append(write_binary(file_path, pd.read_csv(file_path, index_col=0)))
+            if remove_csv:
+                os.remove(file_path)
+        if not recursive:
+            break
+    return converted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert IV_Curve_*.csv files to the binary trace format.')
+    parser.add_argument('paths', nargs='+', help='experiment folders or folders containing them')
+    parser.add_argument('--remove-csv', action='store_true', help='delete the CSV files after conversion')
+    args = parser.parse_args()
+    for folder in args.paths:
+        for target in convert_folder(folder, args.remove_csv):
+            print(target)
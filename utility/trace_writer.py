@@ -0,0 +1,65 @@
+import os
+import time
+
+from utility.trace_files import write_binary
+
+PART_SUFFIX = '.part'  # suffix of a trace that is still being measured or whose measurement was interrupted
+
+
+def format_value(value):
+    """ Formats a value the way DataFrame.to_csv does, empty for NaN. """
+    value = float(value)
+    return '' if value != value else repr(value)
+
+
+class TraceWriter:
+    """
+    Journals the points of one IV curve to disk while they are measured.
+
+    Points are appended to file_path + '.part' in the layout of DataFrame.to_csv (index column first), flushed
+    after every point and synced to disk at most every sync_period seconds, so a crash or an aborted scan leaves
+    every point measured until then in the .part file. finish() writes the final data of the curve next to it
+    and replaces file_path in one step, so file_path only ever holds complete curves. With binary the curve is
+    also stored in the binary trace format.
+    """
+    def __init__(self, file_path, columns, sync_period=1.0, binary=False):
+        self.file_path = file_path
+        self.part_path = file_path + PART_SUFFIX
+        self.columns = list(columns)
+        self.sync_period = sync_period
+        self.binary = binary
+        self.last_sync = time.monotonic()
+        self.n_points = 0
+        self.file = open(self.part_path, 'w', newline='')
+        self.file.write(','.join([''] + self.columns) + '\n')
+        self.file.flush()
+
+    def append(self, index, values):
+        self.file.write('%d,%s\n' % (index, ','.join(format_value(value) for value in values)))
+        self.file.flush()
+        self.n_points += 1
+        if time.monotonic() - self.last_sync >= self.sync_period:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.last_sync = time.monotonic()
+
+    def finish(self, data):
+        """ Stores the DataFrame data as the complete curve at file_path and removes the journal. """
+        self.file.close()
+        temporary_path = self.file_path + '.tmp'
+        with open(temporary_path, 'w', newline='') as f:
+            data.to_csv(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.file_path)
+        if self.binary:
+            write_binary(self.file_path, data)
+        os.remove(self.part_path)
+
+    def close(self):
+        """ Keeps the points written so far in the .part file, for an interrupted curve. """
+        if not self.file.closed:
+            self.sync()
+            self.file.close()